@@ -0,0 +1,206 @@
+import asyncio
+import time as ttime
+from concurrent.futures import ThreadPoolExecutor
+
+from piezo_feedback.mini_profile import print_msg_now
+from piezo_feedback.piezo_fb import PiezoFeedback
+
+
+class AsyncPiezoFeedback(PiezoFeedback):
+    # asyncio variant of the feedback loop. New camera frames, parameter/status PVs and shutter states are
+    # turned into asyncio events (ophyd callbacks hand them over with call_soon_threadsafe), so the loop
+    # waits on events with timeouts instead of sleeping for fixed periods. Frame readout and fitting run on one
+    # frame thread (see run_frame_task), the other blocking Channel Access gets/puts in the default executor,
+    # pitch moves are awaited through their ophyd status.
+    def __init__(self, *args, frame_timeout=2, move_timeout=5, heartbeat_period=0.7, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.frame_timeout = frame_timeout
+        self.move_timeout = move_timeout
+        self.heartbeat_period = heartbeat_period
+        self._loop = None
+        self._tasks = []
+        self._frame_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="piezo_fb_frames")
+
+    def _notify(self, event):
+        def callback(**kwargs):
+            self._loop.call_soon_threadsafe(event.set)
+
+        return callback
+
+    def _subscribe_events(self):
+        self._frame_event = asyncio.Event()
+        self._state_event = asyncio.Event()
+        state_signals = [
+            self.hhm.fb_status,
+            self.hhm.fb_hostname,
+            self.hhm.fb_center,
+            self.hhm.fb_line,
+            self.hhm.fb_nlines,
+            self.hhm.fb_pcoeff,
+            self.shutters["FE Shutter"].state,
+            self.shutters["PH Shutter"].state,
+        ]
+        frame_callback = self._notify(self._frame_event)
+        state_callback = self._notify(self._state_event)
+        self._subscriptions = [
+            (self.bpm_es.image.array_counter, self.bpm_es.image.array_counter.subscribe(frame_callback, run=False))
+        ]
+        for signal in state_signals:
+            self._subscriptions.append((signal, signal.subscribe(state_callback, run=False)))
+
+    def _notify_state(self):
+        # for the state changes that are not PVs, e.g. use_dark_model
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._state_event.set)
+
+    def _unsubscribe_events(self):
+        for signal, cid in self._subscriptions:
+            signal.unsubscribe(cid)
+        self._subscriptions = []
+
+    @property
+    def active(self):
+        return self.local_hosting and self.feedback_on and self.shutters_open
+
+    async def wait_until_active(self):
+        while not self.active:
+            self._state_event.clear()
+            await self._state_event.wait()
+
+    async def wait_for_state_change(self, timeout):
+        # waits up to timeout, returns early when a parameter or shutter PV changes
+        self._state_event.clear()
+        try:
+            await asyncio.wait_for(self._state_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run_blocking(self, fn, *args):
+        return await self._loop.run_in_executor(None, fn, *args)
+
+    async def run_frame_task(self, fn, *args):
+        # the frame reads share the band profile buffer, previous_image and image_timestamp, so the feedback
+        # and dark loops run them (and what uses their results) one at a time
+        return await self._loop.run_in_executor(self._frame_executor, fn, *args)
+
+    async def wait_for_frame(self):
+        # with triggered acquisition there is no frame until find_beam_position fires the trigger
+        if self.triggered_acquisition:
+            return
+        self._frame_event.clear()
+        await asyncio.wait_for(self._frame_event.wait(), self.frame_timeout)
+
+    async def move_pitch_async(self, pitch_target):
+        future = self._loop.create_future()
+
+        def resolve():
+            if not future.done():
+                future.set_result(None)
+
+        self._move_issued = ttime.time()
+        status = self.hhm.pitch.set(pitch_target)
+        status.add_callback(lambda status: self._loop.call_soon_threadsafe(resolve))
+        await asyncio.wait_for(future, self.move_timeout)
+        self._move_done = ttime.time()
+        if not status.success:
+            raise RuntimeError(f"pitch move to {pitch_target} failed")
+
+    async def adjust_pitch_async(self):
+        try:
+            await self.wait_for_frame()
+        except asyncio.TimeoutError:
+            await self.run_blocking(self.report_adjustment, False, "frame timeout")
+            return False
+
+        parameters = self.parameters
+        center_rb, err_msg = await self.run_frame_task(self.find_beam_position, parameters)
+        if err_msg == "stale frame":
+            return True
+        if (center_rb is not None) and self.is_outlier(center_rb):
+            return True
+        adjustment_success = False
+        if center_rb is not None:
+            pitch_target = await self.run_frame_task(self.pitch_target_for, center_rb, parameters)
+            try:
+                if (pitch_target is not None) and (pitch_target > 100):
+                    await self.move_pitch_async(pitch_target)
+                adjustment_success = True
+            except Exception:
+                pass
+        await self.run_blocking(self.report_adjustment, adjustment_success, err_msg)
+        return adjustment_success
+
+    async def feedback_loop(self):
+        while True:
+            await self.wait_until_active()
+            adjustment_success = await self.adjust_pitch_async()
+            if adjustment_success:
+                await self.wait_for_state_change(self.pid.sample_time)
+
+    def use_dark_model(self, **kwargs):
+        super().use_dark_model(**kwargs)
+        self._notify_state()
+
+    @property
+    def learning_dark(self):
+        return (self.dark_model is not None) and self.local_hosting and not self.shutters_open
+
+    def learn_dark_frame(self):
+        # checked again on the frame thread, the shutters may have opened while waiting for the frame
+        if self.learning_dark:
+            self.update_dark_model()
+
+    async def dark_loop(self):
+        # learns the dark model from every frame taken while the shutters are closed, see
+        # PiezoFeedback.use_dark_model
+        while True:
+            while not self.learning_dark:
+                self._state_event.clear()
+                await self._state_event.wait()
+            try:
+                await self.wait_for_frame()
+            except asyncio.TimeoutError:
+                continue
+            await self.run_frame_task(self.learn_dark_frame)
+
+    def toggle_heartbeat(self):
+        try:
+            self.hhm.fb_heartbeat.put(int(self.hhm.fb_heartbeat.get() == 0))
+        except Exception:
+            # no heartbeat emitted is an indicator that something went wrong !
+            pass
+
+    async def heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_period)
+            if self.local_hosting:
+                await self.run_blocking(self.toggle_heartbeat)
+
+    async def run_async(self):
+        self._loop = asyncio.get_running_loop()
+        self._subscribe_events()
+        self._tasks = [
+            asyncio.create_task(self.feedback_loop()),
+            asyncio.create_task(self.heartbeat_loop()),
+            asyncio.create_task(self.dark_loop()),
+        ]
+        try:
+            # the heartbeat stops together with the feedback loop
+            await asyncio.gather(*self._tasks)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print_msg_now(f"Feedback loop stopped: {e}")
+        finally:
+            for task in self._tasks:
+                task.cancel()
+            self._unsubscribe_events()
+
+    def stop(self):
+        # can be called from any thread
+        if self._loop is not None:
+            for task in self._tasks:
+                self._loop.call_soon_threadsafe(task.cancel)
+
+    def run(self):
+        asyncio.run(self.run_async())
@@ -0,0 +1,108 @@
+import json
+import os
+import time as ttime
+
+import numpy as np
+
+CALIBRATION_FILE = os.path.expanduser("~/.piezo_feedback_calibration.json")
+
+
+def recommend_gain(plant_gain, delay_samples):
+    # Fastest non-oscillating gain for the loop e[k+1] = e[k] - plant_gain * Kp * e[k - d], i.e. a pitch
+    # correction that shows up d loop iterations later. The characteristic polynomial z^(d+1) - z^d + a has a
+    # double real root at z = d / (d + 1) for a = (d / (d + 1))^d / (d + 1): a = 1 (deadbeat) for d = 0,
+    # 1/4 for d = 1, 4/27 for d = 2, ...
+    d = max(int(delay_samples), 0)
+    return (d / (d + 1)) ** d / (d + 1) / plant_gain
+
+
+def _record_positions(feedback, record_time):
+    samples = []
+    t_end = ttime.time() + record_time
+    while ttime.time() < t_end:
+        position, err_msg = feedback.find_beam_position()
+        timestamp = feedback.image_timestamp
+        if position is not None and (len(samples) == 0 or timestamp != samples[-1][0]):
+            samples.append((timestamp, position))
+    return np.array(samples).reshape(-1, 2)
+
+
+def measure_step_response(feedback, step=0.1, n_cycles=2, record_time=1.0, n_settled=5):
+    # steps the pitch around its current position (0, +step, 0, -step, ...) and records the beam position on
+    # the camera after each step; the feedback has to be off
+    if feedback.feedback_on and feedback.local_hosting:
+        raise RuntimeError("Turn off the feedback before calibrating the loop gain")
+    pitch_start = feedback.pitch_readback.get()
+    offsets = np.tile([0, step, 0, -step], n_cycles)
+    steps = []
+    try:
+        for offset in offsets:
+            t_move = ttime.time()
+            feedback.hhm.pitch.move(pitch_start + offset)
+            samples = _record_positions(feedback, record_time)
+            if len(samples) < n_settled:
+                raise RuntimeError(f"Only {len(samples)} usable frames after the pitch step")
+            steps.append({"pitch": pitch_start + offset, "t_move": t_move, "samples": samples})
+    finally:
+        feedback.hhm.pitch.move(pitch_start)
+    return steps
+
+
+def analyze_step_response(steps, n_settled=5):
+    pitches = np.array([step["pitch"] for step in steps])
+    settled = np.array([np.mean(step["samples"][-n_settled:, 1]) for step in steps])
+    plant_gain, _ = np.polyfit(pitches, settled, 1)  # px per pitch unit
+
+    latencies, frame_periods = [], []
+    for previous, step in zip(steps[:-1], steps[1:]):
+        timestamps, positions = step["samples"][:, 0], step["samples"][:, 1]
+        frame_periods.append(np.median(np.diff(timestamps)))
+        position_before = np.mean(previous["samples"][-n_settled:, 1])
+        position_after = np.mean(positions[-n_settled:])
+        if step["pitch"] == previous["pitch"]:
+            continue
+        fraction = (positions - position_before) / (position_after - position_before)
+        crossed = np.nonzero(fraction >= 0.5)[0]
+        if crossed.size > 0:
+            latencies.append(timestamps[crossed[0]] - step["t_move"])
+    return {
+        "plant_gain": float(plant_gain),
+        "latency": float(np.median(latencies)) if latencies else 0.0,
+        "frame_period": float(np.median(frame_periods)),
+        "noise": float(np.mean([np.std(step["samples"][-n_settled:, 1]) for step in steps])),
+    }
+
+
+def calibrate_loop_gain(feedback, step=0.1, n_cycles=2, record_time=1.0, n_settled=5, apply=False, path=None):
+    # measures the pitch -> beam position response, proposes the loop gain and stores the result for reuse
+    steps = measure_step_response(
+        feedback, step=step, n_cycles=n_cycles, record_time=record_time, n_settled=n_settled
+    )
+    result = analyze_step_response(steps, n_settled=n_settled)
+    loop_period = max(feedback.pid.sample_time, result["frame_period"])
+    result["delay_samples"] = int(np.ceil(result["latency"] / loop_period)) if loop_period > 0 else 0
+    result["kp"] = recommend_gain(result["plant_gain"], result["delay_samples"])
+    result["pcoeff"] = result["kp"] / feedback.kp_per_pcoeff
+    result["time"] = ttime.time()
+    save_calibration(result, path=path)
+    if apply:
+        apply_calibration(feedback, result)
+    return result
+
+
+def save_calibration(result, path=None):
+    with open(path or CALIBRATION_FILE, "w") as f:
+        json.dump(result, f, indent=2)
+
+
+def load_calibration(path=None):
+    path = path or CALIBRATION_FILE
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def apply_calibration(feedback, result):
+    # through the PV, so that the subscription updates the loop and the value is visible to everyone
+    feedback.hhm.fb_pcoeff.put(result["pcoeff"])
@@ -0,0 +1,145 @@
+import bisect
+from collections import deque
+
+import numpy as np
+
+
+class KalmanPositionEstimator:
+    # Constant velocity Kalman filter of the beam position on the camera (state: position in px, drift velocity in
+    # px/s). Every fitted centroid is fused with the prediction, weighted by the variance of the fit, and the known
+    # pitch moves are applied as a control input (plant_gain px per pitch unit, e.g. from calibration), so a
+    # correction does not show up as beam drift. The process noise is the spectral density of the beam acceleration
+    # (px^2/s^3): larger values follow the beam faster, smaller values average over more frames. The fit variance
+    # only reflects the photon/readout noise of the frame, min_measurement_variance covers the beam jitter the loop
+    # should not follow.
+    def __init__(
+        self, process_noise=100.0, measurement_variance=0.25, min_measurement_variance=0.0, plant_gain=None
+    ):
+        self.process_noise = process_noise
+        self.measurement_variance = measurement_variance  # px^2, for the measurements without a fit variance
+        self.min_measurement_variance = min_measurement_variance
+        self.plant_gain = plant_gain
+        self.reset()
+
+    def reset(self):
+        self.state = None
+        self.covariance = None
+        self.last_time = None
+        self.last_pitch = None
+
+    def predict(self, timestamp, pitch=None):
+        dt = max(timestamp - self.last_time, 0.0)
+        F = np.array([[1.0, dt], [0.0, 1.0]])
+        Q = self.process_noise * np.array([[dt**3 / 3, dt**2 / 2], [dt**2 / 2, dt]])
+        self.state = F @ self.state
+        if self.plant_gain is not None and pitch is not None and self.last_pitch is not None:
+            self.state[0] += self.plant_gain * (pitch - self.last_pitch)
+        self.covariance = F @ self.covariance @ F.T + Q
+
+    def update(self, position, timestamp, variance=None, pitch=None):
+        # returns the filtered position
+        if self.state is not None and timestamp <= self.last_time:
+            return self.state[0]  # the same frame analyzed again (or an older one) is not a new measurement
+        if variance is None or not np.isfinite(variance) or variance <= 0:
+            variance = self.measurement_variance
+        variance = max(variance, self.min_measurement_variance)
+        if self.state is None:
+            self.state = np.array([position, 0.0])
+            self.covariance = np.diag([variance, 0.0])  # no drift until the process noise adds some
+        else:
+            self.predict(timestamp, pitch=pitch)
+            innovation = position - self.state[0]
+            gain = self.covariance[:, 0] / (self.covariance[0, 0] + variance)
+            self.state = self.state + gain * innovation
+            self.covariance = self.covariance - np.outer(gain, self.covariance[0, :])
+        self.last_time = timestamp
+        self.last_pitch = pitch
+        return self.state[0]
+
+    @property
+    def position(self):
+        return None if self.state is None else self.state[0]
+
+    @property
+    def position_variance(self):
+        return None if self.covariance is None else self.covariance[0, 0]
+
+
+class _RollingMedian:
+    # median of the last `window` samples, kept in a sorted list: the bisections are O(log window) and the list
+    # insert/delete is a memmove of at most `window` pointers
+    def __init__(self, window):
+        self._samples = deque(maxlen=window)
+        self._sorted = []
+
+    def append(self, value):
+        if len(self._samples) == self._samples.maxlen:
+            del self._sorted[bisect.bisect_left(self._sorted, self._samples[0])]
+        self._samples.append(value)
+        bisect.insort(self._sorted, value)
+
+    def __len__(self):
+        return len(self._sorted)
+
+    @property
+    def median(self):
+        n = len(self._sorted)
+        if n % 2:
+            return self._sorted[n // 2]
+        return 0.5 * (self._sorted[n // 2 - 1] + self._sorted[n // 2])
+
+
+class HampelFilter:
+    # Streaming Hampel filter of the centroids: a centroid further than n_sigma robust standard deviations from
+    # the rolling median of the last `window` centroids is rejected. The robust standard deviation is taken from
+    # the rolling median of the absolute differences of successive centroids (sigma = median|diff| / (0.6745
+    # sqrt(2))), which is computed in the same amortized cost as the median, unlike the MAD of the window. All
+    # centroids enter the windows, so a real step of the beam is accepted once it fills half of the window.
+    def __init__(self, window=21, n_sigma=4, min_samples=5, min_sigma=0.0):
+        self.window = window
+        self.n_sigma = n_sigma
+        self.min_samples = min_samples
+        self.min_sigma = min_sigma
+        self.reset()
+        self.n_accepted = 0
+        self.n_rejected = 0
+
+    @property
+    def sigma(self):
+        if len(self._differences) == 0:
+            return self.min_sigma
+        return max(self._differences.median / (0.6745 * np.sqrt(2)), self.min_sigma)
+
+    def accept(self, position):
+        # True if position is consistent with the recent centroids
+        if position == self._last_position:  # the same frame analyzed again
+            return self._last_accepted
+        accepted = (len(self._positions) < self.min_samples) or (
+            abs(position - self._positions.median) <= self.n_sigma * self.sigma
+        )
+        if self._last_position is not None:
+            self._differences.append(abs(position - self._last_position))
+        self._positions.append(position)
+        self._last_position = position
+        self._last_accepted = accepted
+        if accepted:
+            self.n_accepted += 1
+        else:
+            self.n_rejected += 1
+        return accepted
+
+    def reset(self):
+        self._positions = _RollingMedian(self.window)
+        self._differences = _RollingMedian(self.window)
+        self._last_position = None
+        self._last_accepted = True
+
+
+def robust_inliers(positions, n_sigma=3):
+    # batch counterpart of HampelFilter: mask of the positions within n_sigma robust (MAD) standard deviations of
+    # the median
+    positions = np.asarray(positions, dtype=float)
+    deviations = np.abs(positions - np.median(positions))
+    if positions.size < 3:
+        return np.ones(positions.size, dtype=bool)
+    return deviations <= n_sigma * 1.4826 * np.median(deviations)
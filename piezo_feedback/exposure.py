@@ -0,0 +1,148 @@
+import time as ttime
+
+import numpy as np
+
+
+class ExposureController:
+    # Keeps the peak of the beam profile in the good range of image_processing.check_image_quality (at most 100
+    # counts per summed line) from the frames the feedback analyzes anyway. After every frame the exposure time is
+    # scaled towards target_counts, by at most a factor of max_step per adjustment; a saturated or empty frame has
+    # no usable peak, so it steps the exposure by the full factor. Nothing waits for the camera: the exposure is
+    # put and the frames exposed before the put are ignored until the first frame with the new exposure arrives.
+    def __init__(
+        self,
+        exposure_signal,
+        target_counts=60,
+        tolerance=0.25,
+        max_step=2.0,
+        min_exp_time=0.00002,
+        max_exp_time=1.0,
+    ):
+        self.exposure_signal = exposure_signal
+        self.target_counts = target_counts
+        self.tolerance = tolerance  # relative deviation from target_counts that is left alone
+        self.max_step = max_step
+        self.min_exp_time = min_exp_time
+        self.max_exp_time = max_exp_time
+        self.exp_time = exposure_signal.get()
+        self._put_time = None
+        self.n_adjustments = 0
+
+    def exposure_ratio(self, err_msg, peak_counts):
+        if err_msg == "saturated image":
+            return 1 / self.max_step
+        if err_msg == "empty image" or peak_counts <= 0:
+            return self.max_step
+        ratio = self.target_counts / peak_counts
+        if abs(ratio - 1) <= self.tolerance:
+            return 1.0
+        return np.clip(ratio, 1 / self.max_step, self.max_step)
+
+    def update(self, err_msg, peak_counts, frame_timestamp, exp_time=None):
+        # returns the new exposure time, or None if it was left as is. exp_time is the current exposure time as
+        # tracked by the caller without a Channel Access round trip (e.g. PiezoFeedback.exposure_time, which
+        # follows changes by hand), if None the last exposure time put by the controller is assumed
+        if err_msg not in ("", "saturated image", "empty image") or peak_counts is None:
+            return None  # nothing to learn about the exposure from this frame
+        if self._put_time is not None:
+            if frame_timestamp is not None and (frame_timestamp - self.exp_time) < self._put_time:
+                return None  # exposed before the last adjustment
+            self._put_time = None
+        if exp_time is not None:
+            self.exp_time = exp_time
+        exp_time = self.exp_time * self.exposure_ratio(err_msg, peak_counts)
+        exp_time = float(np.clip(exp_time, self.min_exp_time, self.max_exp_time))
+        if exp_time == self.exp_time:
+            return None
+        self.exposure_signal.put(exp_time)
+        self.exp_time = exp_time
+        self._put_time = ttime.time()
+        self.n_adjustments += 1
+        return exp_time
+
+
+def _collect_frames(feedback, n_frames, not_before=None, timeout=10):
+    # peak counts and analysis latencies of n_frames distinct good frames (exposed after not_before)
+    peaks, latencies, timestamps = [], [], []
+    t_end = ttime.time() + timeout
+    while len(peaks) < n_frames:
+        if ttime.time() > t_end:
+            raise RuntimeError(f"Only {len(peaks)} good frames within {timeout} s")
+        t_start = ttime.perf_counter()
+        position, err_msg = feedback.find_beam_position()
+        latency = ttime.perf_counter() - t_start
+        timestamp = feedback.image_timestamp
+        if position is None or (timestamps and timestamp == timestamps[-1]):
+            continue
+        if not_before is not None and (timestamp - feedback.exposure_time) < not_before:
+            continue
+        peaks.append(feedback.peak_counts)
+        latencies.append(latency)
+        timestamps.append(timestamp)
+    return np.array(peaks), np.array(latencies), np.array(timestamps)
+
+
+def optimize_acquisition(
+    feedback,
+    min_counts=5,
+    margin=3.0,
+    n_frames=20,
+    readout_time=0.0,
+    max_frame_rate=None,
+    headroom=1.2,
+    apply=True,
+    timeout=10,
+):
+    # Shortest exposure and fastest sustainable camera/loop rates. The counts scale with the exposure, so the
+    # exposure is scaled until the weakest of n_frames profile peaks sits margin times above min_counts (the
+    # empty image limit of check_image_quality, counts per summed line). The analysis latency measured at that
+    # exposure (frame read, reduction and fit, + headroom) or the exposure + readout, whichever is longer, gives
+    # the frame period; the loop waits the rest of the frame period after each adjustment.
+    # The feedback should be off, the frames are analyzed here. If the frames at the new exposure fail (fewer than
+    # n_frames good ones within timeout), the original exposure is put back.
+    if feedback.feedback_on and feedback.local_hosting:
+        raise RuntimeError("Turn off the feedback before optimizing the acquisition")
+    exposure_signal = feedback.bpm_es.cam.acquire_time
+    exposure_controller, feedback.exposure_controller = feedback.exposure_controller, None
+    try:
+        original_exp_time = exposure_signal.get()
+        peaks, _, _ = _collect_frames(feedback, n_frames, timeout=timeout)
+        exp_time = original_exp_time * margin * min_counts / peaks.min()
+        if exposure_controller is not None:
+            exp_time = float(np.clip(exp_time, exposure_controller.min_exp_time, exposure_controller.max_exp_time))
+        t_put = ttime.time()
+        exposure_signal.put(exp_time)
+        feedback.exposure_time = exp_time
+        try:
+            peaks, latencies, _ = _collect_frames(feedback, n_frames, not_before=t_put, timeout=timeout)
+        except Exception:
+            exposure_signal.put(original_exp_time)
+            feedback.exposure_time = original_exp_time
+            raise
+    finally:
+        feedback.exposure_controller = exposure_controller
+
+    latency = float(np.median(latencies))
+    frame_period = max(headroom * latency, exp_time + readout_time)
+    if max_frame_rate is not None:
+        frame_period = max(frame_period, 1 / max_frame_rate)
+    result = {
+        "exp_time": exp_time,
+        "peak_counts": float(np.median(peaks)),
+        "latency": latency,
+        "frame_rate": 1 / frame_period,
+        "sample_time": max(frame_period - latency, 0.0),
+    }
+    if apply:
+        apply_acquisition(feedback, result)
+    return result
+
+
+def apply_acquisition(feedback, result):
+    # bpm_es.frame_rate is the measured frame rate (PSFrameRate_RBV), the rate is set through the acquire period
+    # (used by the Fixed Rate trigger mode of the Prosilica)
+    feedback.bpm_es.cam.acquire_period.put(1 / result["frame_rate"])
+    feedback.pid.setSampleTime(result["sample_time"])
+    if feedback.exposure_controller is not None:
+        # keep the exposure controller from pushing the exposure back up
+        feedback.exposure_controller.target_counts = result["peak_counts"]
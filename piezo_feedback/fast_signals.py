@@ -0,0 +1,54 @@
+import time as ttime
+
+import numpy as np
+
+try:
+    import epics
+except ImportError:
+    epics = None
+
+
+class FastSignal:
+    # Thin wrapper around a pyepics PV for the few PVs read every frame (image data, pitch readback).
+    # get_with_timestamp returns the value as a NumPy array together with the IOC timestamp and skips the
+    # OrderedDict that ophyd's read() builds. The PV shares the Channel Access channel with the ophyd signal,
+    # ophyd keeps being used for everything else. Without pyepics the ophyd signal is read instead.
+    def __init__(self, signal, count=None, monitor=False, timeout=2):
+        self.signal = signal
+        self.name = signal.name
+        self.count = count
+        self.monitor = monitor
+        self.timeout = timeout
+        if epics is not None:
+            self._pv = epics.PV(signal.pvname, form="time", auto_monitor=monitor, connection_timeout=timeout)
+        else:
+            self._pv = None
+
+    def get_with_timestamp(self):
+        if self._pv is None:
+            reading = self.signal.read()[self.name]
+            return np.asarray(reading["value"]), reading["timestamp"]
+        reading = self._pv.get_with_metadata(
+            count=self.count, as_numpy=True, timeout=self.timeout, use_monitor=self.monitor, form="time"
+        )
+        if reading is None:
+            raise TimeoutError(f"{self._pv.pvname} did not respond within {self.timeout} s")
+        return reading["value"], reading["timestamp"]
+
+    def get(self):
+        return self.get_with_timestamp()[0]
+
+
+def benchmark_fast_signal(signal, n_reads=100, **kwargs):
+    # per-call time (in s) of ophyd's read() and of FastSignal on the same PV
+    fast_signal = FastSignal(signal, **kwargs)
+    t0 = ttime.perf_counter()
+    for _ in range(n_reads):
+        signal.read()[signal.name]["value"]
+    t1 = ttime.perf_counter()
+    for _ in range(n_reads):
+        fast_signal.get_with_timestamp()
+    t2 = ttime.perf_counter()
+    ophyd_read = (t1 - t0) / n_reads
+    fast_read = (t2 - t1) / n_reads
+    return {"ophyd_read": ophyd_read, "fast_signal": fast_read, "saved": ophyd_read - fast_read}
@@ -0,0 +1,189 @@
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Named shared-memory ring with the latest frame bands, beam profiles and fit results of the feedback loop,
+# so that local consumers (GUIs, diagnostics) do not have to pull the BPM frames over Channel Access again.
+#
+# Layout: a fixed header followed by n_slots slots. Each slot is guarded by its own sequence number
+# (seqlock): it is odd while the slot is being written and even once the slot is complete. The header
+# holds the sequence number and index of the latest complete slot, and the pid of the writer.
+
+FRAME_RING_NAME = "piezo_fb_frames"
+_MAGIC = b"PZFBRNG2"
+
+_header_dtype = np.dtype(
+    [
+        ("magic", "S8"),
+        ("n_slots", "<i8"),
+        ("max_rows", "<i8"),
+        ("max_cols", "<i8"),
+        ("seq", "<i8"),
+        ("slot", "<i8"),
+        ("pid", "<i8"),
+    ]
+)
+
+
+def frame_ring_name(camera_name):
+    # one ring per camera, e.g. frame_ring_name(bpm_es.name) for the loops of FeedbackManager
+    return f"{FRAME_RING_NAME}_{camera_name}"
+
+
+def _writer_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # a process of another user
+        return True
+    return True
+
+
+def _remove_stale_ring(name):
+    # unlinks the ring left over by a writer that did not exit cleanly, a ring that is still written is kept
+    stale = shared_memory.SharedMemory(name=name)
+    writer_pid = None
+    if stale.size >= _header_dtype.itemsize:
+        header = np.ndarray((), dtype=_header_dtype, buffer=stale.buf)
+        if header["magic"] == _MAGIC:
+            writer_pid = int(header["pid"])
+        del header
+    stale.close()
+    if writer_pid is not None and _writer_alive(writer_pid):
+        raise FileExistsError(f"Frame ring {name} is in use by process {writer_pid}")
+    stale.unlink()
+
+
+def _slot_dtype(max_rows, max_cols):
+    return np.dtype(
+        [
+            ("seq", "<i8"),
+            ("timestamp", "<f8"),
+            ("position", "<f8"),  # nan if the fit failed
+            ("line", "<i8"),
+            ("n_lines", "<i8"),
+            ("n_rows", "<i8"),
+            ("n_cols", "<i8"),
+            ("err_msg", "S32"),
+            ("profile", "<f8", (max_rows,)),
+            ("band", "<i2", (max_rows, max_cols)),
+        ]
+    )
+
+
+def _map_ring(buf):
+    header = np.ndarray((), dtype=_header_dtype, buffer=buf)
+    if header["magic"] != _MAGIC:
+        raise ValueError("Shared memory block is not a piezo feedback frame ring")
+    slot_dtype = _slot_dtype(int(header["max_rows"]), int(header["max_cols"]))
+    slots = np.ndarray((int(header["n_slots"]),), dtype=slot_dtype, buffer=buf, offset=_header_dtype.itemsize)
+    return header, slots
+
+
+class SharedFrameRing:
+    # writer side, owned by the feedback process
+    def __init__(self, name=FRAME_RING_NAME, n_slots=8, max_rows=960, max_cols=64):
+        size = _header_dtype.itemsize + n_slots * _slot_dtype(max_rows, max_cols).itemsize
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            _remove_stale_ring(name)
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+
+        header = np.ndarray((), dtype=_header_dtype, buffer=self.shm.buf)
+        header["magic"] = _MAGIC
+        header["n_slots"] = n_slots
+        header["max_rows"] = max_rows
+        header["max_cols"] = max_cols
+        header["seq"] = 0
+        header["slot"] = -1
+        header["pid"] = os.getpid()
+        self.header, self.slots = _map_ring(self.shm.buf)
+        self.max_rows = max_rows
+        self.max_cols = max_cols
+        self._seq = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def begin_write(self, image, beam_profile, line, n_lines, timestamp):
+        # copies the band (if image is given) and the profile into the next slot; returns the slot to pass
+        # to end_write
+        self._seq += 1
+        idx = self._seq % len(self.slots)
+        slot = self.slots[idx]
+        slot["seq"] = 2 * self._seq - 1
+
+        n_rows = min(beam_profile.size, self.max_rows)
+        slot["profile"][:n_rows] = beam_profile[:n_rows]
+        if image is not None:
+            idx_lo = int(line - np.floor(n_lines / 2))
+            band = image[:n_rows, max(idx_lo, 0) : max(idx_lo, 0) + min(n_lines, self.max_cols)]
+            n_cols = band.shape[1]
+            slot["band"][:n_rows, :n_cols] = band
+        else:  # only the profile is available when the band is binned on the IOC
+            n_cols = 0
+
+        slot["timestamp"] = timestamp
+        slot["line"] = line
+        slot["n_lines"] = n_lines
+        slot["n_rows"] = n_rows
+        slot["n_cols"] = n_cols
+        return idx
+
+    def end_write(self, idx, beam_position, err_msg):
+        slot = self.slots[idx]
+        slot["position"] = np.nan if beam_position is None else beam_position
+        slot["err_msg"] = err_msg.encode()[:32]
+        slot["seq"] = 2 * self._seq
+        self.header["slot"] = idx
+        self.header["seq"] = self._seq
+
+    def close(self):
+        del self.header, self.slots
+        self.shm.close()
+        self.shm.unlink()
+
+
+class SharedFrameRingReader:
+    # consumer side, e.g. SharedFrameRingReader(frame_ring_name("bpm_es")). read_latest returns views into
+    # shared memory (no copies); the data is only consistent if is_valid(frame) still returns True after the
+    # consumer is done with it.
+    def __init__(self, name):
+        self.shm = shared_memory.SharedMemory(name=name)
+        self.header, self.slots = _map_ring(self.shm.buf)
+
+    @property
+    def latest_seq(self):
+        return int(self.header["seq"])
+
+    def read_latest(self):
+        while True:
+            seq = int(self.header["seq"])
+            if seq == 0:
+                return None
+            slot = self.slots[int(self.header["slot"])]
+            if int(slot["seq"]) == 2 * seq:
+                break
+        n_rows, n_cols = int(slot["n_rows"]), int(slot["n_cols"])
+        return {
+            "seq": seq,
+            "timestamp": float(slot["timestamp"]),
+            "position": float(slot["position"]),
+            "err_msg": slot["err_msg"].decode(),
+            "line": int(slot["line"]),
+            "n_lines": int(slot["n_lines"]),
+            "profile": slot["profile"][:n_rows],
+            "band": slot["band"][:n_rows, :n_cols],
+            "_slot": slot,
+        }
+
+    def is_valid(self, frame):
+        return int(frame["_slot"]["seq"]) == 2 * frame["seq"]
+
+    def close(self):
+        del self.header, self.slots
+        self.shm.close()
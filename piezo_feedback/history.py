@@ -0,0 +1,38 @@
+import numpy as np
+
+HISTORY_FIELDS = ("timestamp", "centroid", "setpoint", "pitch_target", "pitch_readback", "dither")
+
+
+class FeedbackHistory:
+    # fixed-size ring buffer of the feedback iterations, see system_identification for the offline analysis
+    def __init__(self, n_max=100000):
+        self._data = np.full((n_max, len(HISTORY_FIELDS)), np.nan)
+        self._idx = 0
+
+    def append(self, timestamp, centroid, setpoint, pitch_target, pitch_readback, dither=0.0):
+        self._data[self._idx % len(self._data)] = (
+            timestamp,
+            centroid,
+            setpoint,
+            pitch_target,
+            pitch_readback,
+            dither,
+        )
+        self._idx += 1
+
+    def get(self):
+        # time-ordered, one column per field
+        n_max = len(self._data)
+        if self._idx <= n_max:
+            data = self._data[: self._idx]
+        else:
+            data = np.roll(self._data, -(self._idx % n_max), axis=0)
+        return {field: data[:, i].copy() for i, field in enumerate(HISTORY_FIELDS)}
+
+    def save(self, path):
+        np.savez(path, **self.get())
+
+
+def load_history(path):
+    with np.load(path) as f:
+        return {field: f[field] for field in HISTORY_FIELDS}
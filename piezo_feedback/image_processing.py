@@ -1,4 +1,5 @@
 from datetime import datetime
+from functools import lru_cache
 
 import numpy as np
 from scipy.optimize import curve_fit
@@ -13,23 +14,211 @@ def gauss(x, *p):
     return A * np.exp(-((x - mu) ** 2) / (2.0 * sigma**2))
 
 
-def reduce_image(image, line, n_lines):
+def gauss_jacobian(x, *p):
+    # analytic derivatives of gauss with respect to A, mu and sigma, for curve_fit
+    A, mu, sigma = p
+    d = x - mu
+    e = np.exp(-(d**2) / (2.0 * sigma**2))
+    jacobian = np.empty((x.size, 3))
+    jacobian[:, 0] = e
+    jacobian[:, 1] = A * e * d / sigma**2
+    jacobian[:, 2] = jacobian[:, 1] * d / sigma
+    return jacobian
+
+
+@lru_cache(maxsize=8)
+def fit_coordinates(npts):
+    # the fit counts the rows from the end of the profile; shared between the frames, so read-only
+    x = np.arange(0, npts, dtype=np.float64)[::-1]
+    x.flags.writeable = False
+    return x
+
+
+@lru_cache(maxsize=8)
+def binned_fit_coordinates(npts, binning):
+    # fit coordinates of the bin centers of a profile binned by binning (the incomplete last bin is dropped)
+    n_bins = npts // binning
+    x = fit_coordinates(npts)[: n_bins * binning].reshape(n_bins, binning).mean(axis=1)
+    x.flags.writeable = False
+    return x
+
+
+def bin_profile(beam_profile, binning):
+    n_bins = beam_profile.size // binning
+    return beam_profile[: n_bins * binning].reshape(n_bins, binning).mean(axis=1)
+
+
+def coarse_gauss(beam_profile, binning):
+    # A, mu, sigma of the profile binned by binning, from a parabola fitted to the log of the bins above half
+    # maximum (weighted by the squared bin values, the log amplifies the noise of the low bins); a linear least
+    # squares problem of a few dozen points instead of an iterative fit
+    binned = bin_profile(beam_profile, binning)
+    above_half = binned > 0.5 * binned.max()
+    if np.count_nonzero(above_half) < 3:
+        raise ValueError("the beam is too narrow for the binning")
+    x = binned_fit_coordinates(beam_profile.size, binning)[above_half]
+    x0 = x.mean()
+    c2, c1, c0 = np.polyfit(x - x0, np.log(binned[above_half]), 2, w=binned[above_half])
+    if c2 >= 0:
+        raise ValueError("the coarse profile is not peaked")
+    sigma = np.sqrt(-1 / (2 * c2))
+    mu = x0 - c1 / (2 * c2)
+    return np.exp(c0 - c1**2 / (4 * c2)), mu, sigma
+
+
+def refine_gauss(x, y, p0, n_iterations=10, tolerance=1e-3):
+    # Gauss-Newton refinement of a gauss fit that starts close to the optimum (e.g. from coarse_gauss), without
+    # the setup cost of curve_fit; returns the coefficients and their covariance like curve_fit
+    p = np.asarray(p0, dtype=float)
+    for _ in range(n_iterations):
+        jacobian = gauss_jacobian(x, *p)
+        step = np.linalg.lstsq(jacobian, y - gauss(x, *p), rcond=None)[0]
+        p = p + step
+        if abs(step[1]) < tolerance:
+            break
+    else:
+        raise RuntimeError("the gauss refinement did not converge")
+    jacobian = gauss_jacobian(x, *p)
+    residual = y - gauss(x, *p)
+    return p, np.linalg.inv(jacobian.T @ jacobian) * (residual @ residual) / max(x.size - 3, 1)
+
+
+def band_slice(line, n_lines):
+    idx_lo = int(line - np.floor(n_lines / 2))
+    idx_hi = int(line + np.ceil(n_lines / 2))
+    return slice(idx_lo, idx_hi)
+
+
+def sum_band(image, band, out=None):
+    return np.sum(image[:, band], axis=1, dtype=np.float64, out=out)
+
+
+def reduce_image(image, line, n_lines, band=None, out=None, background=None):
     # the old way:
     # sum_lines = sum(image[:, [i for i in range(int(line - np.floor(n_lines/2)),
     #                                            int(line + np.ceil(n_lines/2)))]].transpose())
 
-    idx_lo = int(line - np.floor(n_lines / 2))
-    idx_hi = int(line + np.ceil(n_lines / 2))
-    beam_profile = np.sum(image[:, idx_lo:idx_hi], axis=1)
+    # band (see band_slice) and the float64 output buffer can be cached by the caller
+    # background is the dark profile of the band (see DarkModel), if None it is estimated from the profile
+    if band is None:
+        band = band_slice(line, n_lines)
+    beam_profile = sum_band(image, band, out=out)
+    if background is None:
+        return subtract_background(beam_profile)
+    beam_profile -= background
+    return beam_profile
 
-    if len(beam_profile) > 0:
-        beam_profile = beam_profile - np.mean(
-            beam_profile[:200]
-        )  # empirically we determined that first 200 pixels are BKG
 
+def subtract_background(beam_profile):
+    # in place, beam_profile has to be a float array
+    if len(beam_profile) > 0:
+        beam_profile -= np.mean(beam_profile[:200])  # empirically we determined that first 200 pixels are BKG
     return beam_profile
 
 
+def fit_gauss_batch(profiles, n_iterations=50, tolerance=1e-3, window_sigmas=4, return_variance=False):
+    # Levenberg-Marquardt fit of gauss to every row of the 2D array profiles at once, in the coordinates of
+    # analyze_profile. All profiles take the same number of iterations, with one damping factor per profile,
+    # so the cost is a few array operations per iteration instead of a curve_fit call per profile. Each profile
+    # is fitted within +-window_sigmas sigma of its peak (a window of the same length for all of them).
+    # Returns the (n, 3) A, mu, sigma coefficients and the convergence flags (a step that moved mu by less than
+    # tolerance px, as refine_gauss, or changed the cost by less than 1e-6 relative); with return_variance also
+    # the variances of mu, as analyze_profile.
+    profiles = np.atleast_2d(np.asarray(profiles, dtype=np.float64))
+    n_profiles, npts = profiles.shape
+    rows = np.arange(n_profiles)[:, None]
+
+    # starting point: the peak and its full width at half maximum
+    peaks = profiles.argmax(axis=1)
+    amplitudes = profiles[rows[:, 0], peaks]
+    sigmas = np.maximum(np.count_nonzero(profiles > 0.5 * amplitudes[:, None], axis=1) / 2.355, 1)
+    half_width = min(int(np.ceil(window_sigmas * sigmas.max())), (npts - 1) // 2)  # window <= npts
+    starts = np.clip(peaks - half_width, 0, npts - (2 * half_width + 1))
+    columns = starts[:, None] + np.arange(2 * half_width + 1)
+    x = fit_coordinates(npts)[columns]
+    y = profiles[rows, columns]
+    coeff = np.column_stack([amplitudes, fit_coordinates(npts)[peaks], sigmas])
+
+    def residuals_and_jacobian(coeff):
+        A, mu, sigma = coeff[:, 0:1], coeff[:, 1:2], coeff[:, 2:3]
+        d = x - mu
+        e = np.exp(-(d**2) / (2 * sigma**2))
+        d_mu = A * e * d / sigma**2
+        return y - A * e, (e, d_mu, d_mu * d / sigma)
+
+    def normal_equations(residuals, jacobian):
+        jtj = np.empty((n_profiles, 3, 3))
+        for k in range(3):
+            for m in range(k, 3):
+                jtj[:, k, m] = jtj[:, m, k] = np.einsum("ij,ij->i", jacobian[k], jacobian[m])
+        jtr = np.column_stack([np.einsum("ij,ij->i", column, residuals) for column in jacobian])
+        return jtj, jtr
+
+    residuals, jacobian = residuals_and_jacobian(coeff)
+    cost = np.einsum("ij,ij->i", residuals, residuals)
+    damping = np.full(n_profiles, 1e-3)
+    converged = np.zeros(n_profiles, dtype=bool)
+    diagonal = (np.arange(3), np.arange(3))
+    for _ in range(n_iterations):
+        jtj, jtr = normal_equations(residuals, jacobian)
+        jtj[:, diagonal[0], diagonal[1]] *= 1 + damping[:, None]
+        step = np.linalg.solve(jtj, jtr[:, :, None])[:, :, 0]
+
+        trial = coeff + step
+        trial_residuals, trial_jacobian = residuals_and_jacobian(trial)
+        trial_cost = np.einsum("ij,ij->i", trial_residuals, trial_residuals)
+        # at the minimum once a step moves mu by less than tolerance or hardly lowers the cost, without raising it
+        converged |= (trial_cost <= cost * (1 + 1e-9)) & (
+            (np.abs(step[:, 1]) <= tolerance) | (cost - trial_cost <= 1e-6 * cost)
+        )
+        better = np.isfinite(trial_cost) & (trial_cost <= cost)
+        coeff[better] = trial[better]
+        residuals[better] = trial_residuals[better]
+        for column, trial_column in zip(jacobian, trial_jacobian):
+            column[better] = trial_column[better]
+        cost[better] = trial_cost[better]
+        damping = np.where(better, damping / 10, damping * 10)
+        if converged.all():
+            break
+    coeff[:, 2] = np.abs(coeff[:, 2])
+    if not return_variance:
+        return coeff, converged
+    jtj, _ = normal_equations(residuals, jacobian)
+    with np.errstate(invalid="ignore"):
+        variances = np.linalg.pinv(jtj)[:, 1, 1] * cost / max(x.shape[1] - 3, 1)
+    return coeff, converged, variances
+
+
+class DarkModel:
+    # Per-row dark level of the summed band, learned from the frames taken while the shutters are closed: the
+    # mean of the first n_frames dark profiles, then an exponential moving average over about n_frames. The
+    # model is tied to the band and exposure it was learned for (key, e.g. (line, n_lines, exposure_time)) and
+    # starts over for a new one.
+    def __init__(self, n_frames=50, min_frames=5):
+        self.n_frames = n_frames
+        self.min_frames = min_frames
+        self.reset()
+
+    def reset(self):
+        self.key = None
+        self.profile = None
+        self.n_added = 0
+
+    def add(self, dark_profile, key):
+        if key != self.key or self.profile is None or self.profile.shape != dark_profile.shape:
+            self.reset()
+            self.key = key
+            self.profile = np.zeros(dark_profile.shape)
+        self.n_added += 1
+        self.profile += (dark_profile - self.profile) / min(self.n_added, self.n_frames)
+
+    def background(self, key):
+        # the dark profile to subtract, None until enough dark frames of this band and exposure have been added
+        if key != self.key or self.n_added < self.min_frames:
+            return None
+        return self.profile
+
+
 def check_image_quality(beam_profile, n_lines):
     min_value = beam_profile.min()
     max_value = beam_profile.max()
@@ -43,6 +232,18 @@ def check_image_quality(beam_profile, n_lines):
         return "saturated"
 
 
+def check_stats_quality(max_value, min_value):
+    # per-pixel counterpart of check_image_quality for the IOC-side statistics of the band
+    not_saturated = max_value <= 100
+    not_empty = (max_value - min_value) > 5
+    if not_saturated and not_empty:
+        return "good"
+    if not_saturated:
+        return "empty"
+    if not_empty:
+        return "saturated"
+
+
 # def check_image_quality(image, line, n_lines): WIP
 #     idx_lo = int(line - np.floor(n_lines / 2))
 #     idx_hi = int(line + np.ceil(n_lines / 2))
@@ -62,6 +263,57 @@ def check_image_quality(beam_profile, n_lines):
 
 def analyze_image(image, line=420, center=600, n_lines=1, truncate_data=True, should_print_diagnostics=True):
     beam_profile = reduce_image(image, line, n_lines)
+    return analyze_profile(
+        beam_profile,
+        n_lines=n_lines,
+        truncate_data=truncate_data,
+        should_print_diagnostics=should_print_diagnostics,
+    )
+
+
+def _fit_flanks(x, beam_profile, saturation_level, min_flank_points=3):
+    # Gaussian fit to the unsaturated flanks of a clipped profile: the pixels above 95% of the saturation level
+    # are left out, the flank pixels below 10% of it are mostly background
+    saturated = np.nonzero(beam_profile >= 0.95 * saturation_level)[0]
+    flanks = (beam_profile > 0.1 * saturation_level) & (beam_profile < 0.95 * saturation_level)
+    lo, hi = saturated[0], saturated[-1]
+    n_left, n_right = np.count_nonzero(flanks[:lo]), np.count_nonzero(flanks[hi + 1 :])
+    if min(n_left, n_right) < min_flank_points:
+        raise ValueError("not enough unsaturated pixels on the flanks")
+    p0 = [2 * saturation_level, 0.5 * (x[lo] + x[hi]), max(hi - lo, 2)]
+    return curve_fit(gauss, x[flanks], beam_profile[flanks], p0=p0, jac=gauss_jacobian)
+
+
+def _fit_coarse_to_fine(x, beam_profile, binning, window_sigmas=2):
+    # coarse_gauss on the profile binned by binning, refined at full resolution within +-window_sigmas of the
+    # coarse sigma around the coarse center; beam_profile normalized to its peak as in analyze_profile
+    p0 = coarse_gauss(beam_profile, binning)
+    npts = beam_profile.size
+    peak = int(round(npts - 1 - p0[1]))
+    half_width = int(np.ceil(window_sigmas * abs(p0[2])))
+    window = slice(max(peak - half_width, 0), peak + half_width + 1)
+    return refine_gauss(x[window], beam_profile[window], p0)
+
+
+def analyze_profile(
+    beam_profile,
+    n_lines=1,
+    truncate_data=True,
+    should_print_diagnostics=True,
+    return_variance=False,
+    fit_saturated=False,
+    fit_window_sigmas=None,
+    coarse_binning=None,
+):
+    # note that beam_profile is normalized in place
+    # with return_variance, the variance of the fitted center (from the fit covariance, px^2) is returned as well
+    # with fit_saturated, a saturated profile is fitted on its flanks (see _fit_flanks) instead of being rejected;
+    # the position is returned with the "saturated image" err_msg as the quality flag
+    # with fit_window_sigmas, only the pixels within +-fit_window_sigmas sigma of the peak are fitted, sigma being
+    # estimated from the number of pixels above half maximum (truncate_data fits the half maximum region only)
+    # with coarse_binning, the center and width are estimated on the profile binned by coarse_binning and refined
+    # at full resolution within +-2 coarse sigmas (see _fit_coarse_to_fine); if that fails (e.g. a beam too narrow
+    # for the binning), the profile is fitted as without coarse_binning
     image_quality = check_image_quality(beam_profile, n_lines)
     # image_quality = check_image_quality(image, line, n_lines)
 
@@ -69,23 +321,114 @@ def analyze_image(image, line=420, center=600, n_lines=1, truncate_data=True, sh
     if image_quality == "good":
         try:
             npts = beam_profile.size
-            x = np.arange(0, npts)[::-1]
-            center = npts - beam_profile.argmax()
-            beam_profile /= beam_profile.max()
-            if truncate_data:
-                idx_to_fit = np.where(beam_profile > beam_profile.max() / 2)
-                coeff, var_matrix = curve_fit(gauss, x[idx_to_fit], beam_profile[idx_to_fit], p0=[1, center, 40])
-            else:
-                coeff, var_matrix = curve_fit(gauss, x, beam_profile, p0=[1, center, 40])
+            x = fit_coordinates(npts)
+            peak = beam_profile.argmax()
+            center = npts - peak
+            beam_profile /= beam_profile[peak]
+            coeff = None
+            if coarse_binning:
+                try:
+                    coeff, var_matrix = _fit_coarse_to_fine(x, beam_profile, coarse_binning)
+                except Exception:
+                    pass  # fitted at full resolution below
+            if coeff is None:
+                p0 = [1, center, 40]
+                if truncate_data:
+                    above_half = np.flatnonzero(beam_profile > 0.5)
+                    window = slice(above_half[0], above_half[-1] + 1)
+                elif fit_window_sigmas is not None:
+                    p0[2] = max(np.count_nonzero(beam_profile > 0.5) / 2.355, 1)
+                    half_width = int(np.ceil(fit_window_sigmas * p0[2]))
+                    window = slice(max(peak - half_width, 0), peak + half_width + 1)
+                else:
+                    window = slice(None)
+                coeff, var_matrix = curve_fit(gauss, x[window], beam_profile[window], p0=p0, jac=gauss_jacobian)
             err_msg = ""
+            if return_variance:
+                return coeff[1], err_msg, var_matrix[1, 1]
             return coeff[1], err_msg
         except Exception:
             err_msg = "fitting"
             if should_print_diagnostics:
                 print_msg_now("Feedback error: fitting failure")
             # return None
+    elif image_quality == "saturated" and fit_saturated:
+        err_msg = "saturated image"
+        try:
+            saturation_level = n_lines * 100  # see check_image_quality
+            beam_profile /= saturation_level
+            coeff, var_matrix = _fit_flanks(fit_coordinates(beam_profile.size), beam_profile, 1.0)
+            if return_variance:
+                return coeff[1], err_msg, var_matrix[1, 1]
+            return coeff[1], err_msg
+        except Exception:
+            if should_print_diagnostics:
+                print_msg_now("Feedback error: image is saturated and its flanks could not be fitted")
     else:
         err_msg = f"{image_quality} image"
         if should_print_diagnostics:
             print_msg_now("Feedback error: image is either empty or saturated")
+    if return_variance:
+        return None, err_msg, None
     return None, err_msg
+
+
+class CrossCorrelationEstimator:
+    # Alternative to the Gaussian fit for beams that are not Gaussian: the position of a profile is the position
+    # of a reference profile (taken with the beam at a known position, e.g. fb_center) plus their relative shift,
+    # found as the peak of their FFT cross-correlation with a parabolic sub-pixel refinement. The reference
+    # spectrum, FFT length and buffers are kept between the frames. analyze_profile has the same arguments and
+    # return values as the module level analyze_profile, so it can be used as PiezoFeedback.position_engine.
+    def __init__(self, reference_profile=None, reference_position=None):
+        self.reference_spectrum = None
+        if reference_profile is not None:
+            self.set_reference(reference_profile, reference_position)
+
+    def set_reference(self, reference_profile, reference_position):
+        # reference_position in the coordinates of the fit (rows counted from the end of the profile)
+        npts = reference_profile.size
+        self.npts = npts
+        self.nfft = 1 << int(np.ceil(np.log2(2 * npts)))  # zero padded, no wrap-around of the correlation
+        self._padded = np.zeros(self.nfft)
+        # the noise of the reference outside of the beam only adds noise to the correlation
+        self._padded[:npts] = np.where(reference_profile > 0.05 * reference_profile.max(), reference_profile, 0)
+        self.reference_spectrum = np.conj(np.fft.rfft(self._padded))
+        self.reference_position = reference_position
+
+    def shift(self, beam_profile):
+        # shift of beam_profile with respect to the reference, in pixels of the profile
+        self._padded[: self.npts] = beam_profile
+        xcorr = np.fft.irfft(np.fft.rfft(self._padded) * self.reference_spectrum, self.nfft)
+        k = int(np.argmax(xcorr))
+        shift = float(k)
+        y0, y1, y2 = xcorr[k - 1], xcorr[k], xcorr[(k + 1) % self.nfft]
+        denominator = y0 - 2 * y1 + y2
+        if denominator != 0:
+            shift += 0.5 * (y0 - y2) / denominator
+        if shift > self.nfft / 2:
+            shift -= self.nfft
+        return shift
+
+    def analyze_profile(
+        self,
+        beam_profile,
+        n_lines=1,
+        truncate_data=True,
+        should_print_diagnostics=True,
+        return_variance=False,
+        fit_saturated=False,
+        fit_window_sigmas=None,
+        coarse_binning=None,
+    ):
+        image_quality = check_image_quality(beam_profile, n_lines)
+        position, err_msg = None, f"{image_quality} image"
+        if self.reference_spectrum is None or beam_profile.size != self.npts:
+            err_msg = "no reference profile"
+        elif image_quality == "good":
+            # the fit coordinates run backwards through the profile
+            position, err_msg = self.reference_position - self.shift(beam_profile), ""
+        if err_msg and should_print_diagnostics:
+            print_msg_now(f"Feedback error: {err_msg}")
+        if return_variance:
+            return position, err_msg, None
+        return position, err_msg
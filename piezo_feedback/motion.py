@@ -0,0 +1,69 @@
+import numpy as np
+
+
+class MoveCoalescer:
+    # Dead-band and coalescing for the pitch corrections. Between two moves the successive corrections are
+    # independent estimates of the same correction, so they are averaged; a move is only issued once the
+    # averaged correction is larger than n_sigma times its noise. The centroid noise is estimated from the
+    # differences of successive centroids (var(diff) = 2 var) and propagated to the pitch with the loop gain.
+    def __init__(self, n_sigma=3, max_pending=10, noise_window=50, min_noise=0.0):
+        self.n_sigma = n_sigma
+        self.max_pending = max_pending
+        self.noise_alpha = 2 / (noise_window + 1)
+        self.min_noise = min_noise
+        self.noise_var = None
+        self._last_centroid = None
+        self._last_timestamp = None
+        self._pending = []
+        self.n_moves_issued = 0
+        self.n_moves_suppressed = 0
+
+    def update_noise(self, centroid):
+        if self._last_centroid is not None:
+            half_sq_diff = 0.5 * (centroid - self._last_centroid) ** 2
+            if self.noise_var is None:
+                self.noise_var = half_sq_diff
+            else:
+                self.noise_var += self.noise_alpha * (half_sq_diff - self.noise_var)
+        self._last_centroid = centroid
+
+    @property
+    def noise(self):
+        if self.noise_var is None:
+            return self.min_noise
+        return max(np.sqrt(self.noise_var), self.min_noise)
+
+    def deadband(self, gain, n_pending=1):
+        return self.n_sigma * self.noise * abs(gain) / np.sqrt(n_pending)
+
+    def coalesce(self, centroid, pitch_delta, gain, timestamp=None):
+        # returns the merged correction to apply now, or None if the move is suppressed. A frame analyzed again
+        # (same timestamp, e.g. no new frame since a suppressed move) is not a new estimate and is ignored
+        if timestamp is not None:
+            if timestamp == self._last_timestamp:
+                return None
+            self._last_timestamp = timestamp
+        self.update_noise(centroid)
+        self._pending.append(pitch_delta)
+        if len(self._pending) > self.max_pending:
+            self._pending.pop(0)
+        merged_delta = np.mean(self._pending)
+        if abs(merged_delta) < self.deadband(gain, len(self._pending)):
+            self.n_moves_suppressed += 1
+            return None
+        self._pending = []
+        self.n_moves_issued += 1
+        return merged_delta
+
+    def reset(self):
+        self._pending = []
+        self._last_centroid = None
+        self._last_timestamp = None
+
+    @property
+    def stats(self):
+        return {
+            "moves_issued": self.n_moves_issued,
+            "moves_suppressed": self.n_moves_suppressed,
+            "noise": self.noise,
+        }
@@ -0,0 +1,87 @@
+import time as ttime
+
+import numpy as np
+
+
+class PID:
+    # PID controller for the feedback loop, a drop-in for xas.pid.PID (Kp/Ki/Kd, SetPoint, windup_guard,
+    # setSampleTime, update, output) with:
+    #  - dt taken from the timestamps passed to update (e.g. the frame timestamps), sample_time is only used
+    #    for the first update; a timestamp that is not newer than the last one (the same frame analyzed again)
+    #    leaves the state and the output as they are
+    #  - derivative on the measurement with a first order low-pass filter (derivative_filter is its time
+    #    constant in s), so setpoint changes do not kick the output
+    #  - anti-windup: the integral is clamped to +-windup_guard and frozen while the output is saturated
+    #  - output_limit (max |output|), rate_limit (max change of the output per s) and a feedforward term
+    def __init__(self, P=0.2, I=0.0, D=0.0, current_time=None):  # noqa E741
+        self.Kp = P
+        self.Ki = I
+        self.Kd = D
+        self.sample_time = 0.0
+        self.windup_guard = 20.0
+        self.derivative_filter = 0.0
+        self.output_limit = None
+        self.rate_limit = None
+        self.clear()
+
+    def clear(self):
+        self.SetPoint = 0.0
+        self.PTerm = 0.0
+        self.ITerm = 0.0
+        self.DTerm = 0.0
+        self.last_error = 0.0
+        self.last_feedback = None
+        self.last_time = None
+        self.output = 0.0
+
+    def setKp(self, proportional_gain):
+        self.Kp = proportional_gain
+
+    def setKi(self, integral_gain):
+        self.Ki = integral_gain
+
+    def setKd(self, derivative_gain):
+        self.Kd = derivative_gain
+
+    def setWindup(self, windup):
+        self.windup_guard = windup
+
+    def setSampleTime(self, sample_time):
+        self.sample_time = sample_time
+
+    def update(self, feedback_value, current_time=None, feedforward=0.0):
+        if current_time is None:
+            current_time = ttime.time()
+        if self.last_time is None:
+            delta_time = self.sample_time
+        elif current_time <= self.last_time:
+            return self.output
+        else:
+            delta_time = current_time - self.last_time
+
+        error = self.SetPoint - feedback_value
+        self.PTerm = self.Kp * error
+
+        if (self.last_feedback is not None) and (delta_time > 0):
+            derivative = -(feedback_value - self.last_feedback) / delta_time
+            smoothing = delta_time / (self.derivative_filter + delta_time)
+            self.DTerm += smoothing * (derivative - self.DTerm)
+
+        integral = np.clip(self.ITerm + error * delta_time, -self.windup_guard, self.windup_guard)
+        output = self.PTerm + self.Ki * integral + self.Kd * self.DTerm + feedforward
+        if self.output_limit is not None and abs(output) > self.output_limit:
+            output = np.clip(output, -self.output_limit, self.output_limit)
+            if np.sign(error) != np.sign(output):  # integrating would pull the output out of saturation
+                self.ITerm = integral
+        else:
+            self.ITerm = integral
+
+        if self.rate_limit is not None and delta_time > 0:
+            max_change = self.rate_limit * delta_time
+            output = np.clip(output, self.output - max_change, self.output + max_change)
+
+        self.output = float(output)
+        self.last_error = error
+        self.last_feedback = feedback_value
+        self.last_time = current_time
+        return self.output
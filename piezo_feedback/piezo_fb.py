@@ -1,26 +1,56 @@
 import sys
+import threading
 import time as ttime
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-from xas.pid import PID
 
 _args = sys.argv
 if len(_args) > 1:  # if ran as a script with PATH
     PATH = _args[1]
 else:  # if imported as a module
     PATH = ""
-    from piezo_feedback.image_processing import analyze_image
+    from piezo_feedback.calibration import apply_calibration, load_calibration
+    from piezo_feedback.estimators import HampelFilter, KalmanPositionEstimator, robust_inliers
+    from piezo_feedback.exposure import ExposureController
+    from piezo_feedback.fast_signals import FastSignal
+    from piezo_feedback.frame_buffer import SharedFrameRing, frame_ring_name
+    from piezo_feedback.history import FeedbackHistory
+    from piezo_feedback.image_processing import (
+        CrossCorrelationEstimator,
+        DarkModel,
+        analyze_profile,
+        band_slice,
+        check_image_quality,
+        check_stats_quality,
+        fit_gauss_batch,
+        reduce_image,
+        subtract_background,
+    )
     from piezo_feedback.mini_profile import print_msg_now
+    from piezo_feedback.motion import MoveCoalescer
+    from piezo_feedback.pid import PID
+    from piezo_feedback.pva_source import PVAFrameSource
+
+
+# Immutable snapshot of the feedback parameter PVs. The subscription callbacks replace it as a whole and the
+# loop reads it once per iteration, so an iteration never sees a half-updated set of parameters.
+FeedbackParameters = namedtuple(
+    "FeedbackParameters", ["center", "line", "n_lines", "n_measures", "pcoeff", "status", "host"]
+)
 
 
 class PiezoFeedback:
-    def __init__(self, hhm, bpm_es, shutters, sample_time=0.01, local_hostname="remote"):
+    kp_per_pcoeff = 0.004
+
+    def __init__(self, hhm, bpm_es, shutters, sample_time=0.01, local_hostname="remote", calibration_file=None):
         self.hhm = hhm
         self.bpm_es = bpm_es
         self.shutters = shutters
         self.local_hostname = local_hostname
 
-        P = 0.004 * 1
+        P = self.kp_per_pcoeff * 1
         I = 0  # 0.02  # noqa E741
         D = 0  # 0.01
         self.pid = PID(P, I, D)
@@ -32,25 +62,67 @@ class PiezoFeedback:
 
         # self.go = 0
         self.should_print_diagnostics = True
+        self.should_emit_heartbeat = True
         self.truncate_data = False
-
+        self.fit_saturated = False  # fit saturated profiles on their flanks, see image_processing.analyze_profile
+        self.fit_window_sigmas = 4  # fit only +-4 sigma around the peak, None for the whole profile
+        self.coarse_binning = None  # e.g. 4, locate the peak on the binned profile first, see analyze_profile
+        self.analysis_executor = None  # e.g. the thread pool shared by FeedbackManager
+        self.frame_ring = None
+        self.image_source = None  # anything with get_with_timestamp(), e.g. fast_signals.FastSignal
+        self.image_timestamp = None
+        self.position_variance = None  # of the last fitted position, px^2
+        self.position_estimator = None  # see use_position_estimator
+        self.outlier_filter = None  # see use_outlier_rejection
+        self.peak_counts = None  # profile maximum per summed line of the last frame
+        self.exposure_controller = None  # see use_exposure_control
+        self.dark_model = None  # see use_dark_model
+        self.position_engine = None  # Gaussian fit (analyze_profile) if None, see use_cross_correlation
+        self._reference_key = None
+        self.pitch_readback = self.hhm.pitch.user_readback
+        self.position_source = "image"  # or "stats"/"profile", see use_stats_centroid/use_ioc_binning
+        self._plugin_config = {}  # original values of the plugin settings changed by the IOC-side sources
+        self.triggered_acquisition = False
+
+        # frames exposed before the last pitch move was done (+ settle_time) are skipped without analysis, and
+        # reported as an error once no fresh frame came for stale_timeout (e.g. a frozen camera)
+        self.settle_time = 0.005
+        self.stale_timeout = 2
+        self._move_issued = None
+        self._move_done = None
+        self._stale_since = None
+        self.n_stale_frames = 0
+
+        self.move_coalescer = None  # see use_move_coalescing
+        self.motion_stats_signal = None
+        self.motion_stats_period = 60
+        self._motion_stats_start = ttime.time()
+        self.exposure_time = self.bpm_es.cam.acquire_time.get()
+
+        self._parameters_lock = threading.Lock()
+        self._band_key = None  # (line, n_lines) for which the band slice and profile buffer were made
         self.read_fb_parameters()
         self.subscribe_fb_parameters()
+        self.calibration = None
+        if calibration_file is not None:  # stored by calibration.calibrate_loop_gain
+            self.calibration = load_calibration(calibration_file)
+            if self.calibration is not None:
+                apply_calibration(self, self.calibration)
 
         self.read_shutter_status()
         self.subscribe_shutter_status()
+        self.subscribe_exposure_time()
 
         # self._fb_step_start = 0
         self._hb_step_start = None  # heartbeat timer
         self.previous_image = None
         self.previous_image_age = None
 
-        #
-        # self._n_max_data = 500
-        # self._pitch_vals = np.zeros(self._n_max_data)
-        # self._centers = np.zeros(self._n_max_data)
-        # self._timestamps = np.zeros(self._n_max_data)
-        # self._idx = 0
+        self.history = None  # see record_history
+        self.dither = 0.0
+        self._dither_offset = 0.0
+        self._dither_rng = np.random.default_rng()
+        self._pitch_command = None
 
     def set_fb_parameters(self, center, line, n_lines, n_measures, pcoeff, host):
         self.hhm.fb_center.put(center)
@@ -61,42 +133,87 @@ class PiezoFeedback:
         self.hhm.fb_hostname.put(host)
 
     def read_fb_parameters(self):
-        self.line = int(self.hhm.fb_line.get())
-        self.center = float(self.hhm.fb_center.get())
-        self.pid.SetPoint = self.center
-        self.n_lines = int(self.hhm.fb_nlines.get())
-        self.n_measures = int(self.hhm.fb_nmeasures.get())
-        self.pcoeff = self.hhm.fb_pcoeff.get()
-        self.pid.Kp = float(0.004 * self.pcoeff)
-        self.status = bool(self.hhm.fb_status.get())
-        self.host = str(self.hhm.fb_hostname.get())
+        parameters = FeedbackParameters(
+            center=float(self.hhm.fb_center.get()),
+            line=int(self.hhm.fb_line.get()),
+            n_lines=int(self.hhm.fb_nlines.get()),
+            n_measures=int(self.hhm.fb_nmeasures.get()),
+            pcoeff=float(self.hhm.fb_pcoeff.get()),
+            status=bool(self.hhm.fb_status.get()),
+            host=str(self.hhm.fb_hostname.get()),
+        )
+        with self._parameters_lock:
+            self.parameters = parameters
+        self.apply_pid_parameters(parameters)
+
+    def update_fb_parameters(self, **kwargs):
+        with self._parameters_lock:
+            self.parameters = self.parameters._replace(**kwargs)
+
+    def apply_pid_parameters(self, parameters):
+        self.pid.SetPoint = parameters.center
+        self.pid.Kp = self.kp_per_pcoeff * parameters.pcoeff
+
+    @property
+    def center(self):
+        return self.parameters.center
+
+    @property
+    def line(self):
+        return self.parameters.line
+
+    @property
+    def n_lines(self):
+        return self.parameters.n_lines
+
+    @property
+    def n_measures(self):
+        return self.parameters.n_measures
+
+    @property
+    def pcoeff(self):
+        return self.parameters.pcoeff
+
+    @property
+    def status(self):
+        return self.parameters.status
+
+    @property
+    def host(self):
+        return self.parameters.host
 
     def current_fb_parameters(self):
-        return (self.center, self.line, self.n_lines, self.n_measures, self.pcoeff, self.host)
+        parameters = self.parameters
+        return (
+            parameters.center,
+            parameters.line,
+            parameters.n_lines,
+            parameters.n_measures,
+            parameters.pcoeff,
+            parameters.host,
+        )
 
     def subscribe_fb_parameters(self):
         def update_fb_kp(value, old_value, **kwargs):
-            self.pcoeff = float(value)
-            self.pid.Kp = 0.004 * float(value)
+            self.update_fb_parameters(pcoeff=float(value))
 
         def update_fb_nmeasures(value, old_value, **kwargs):
-            self.n_measures = int(value)
+            self.update_fb_parameters(n_measures=int(value))
 
         def update_fb_nlines(value, old_value, **kwargs):
-            self.n_lines = int(value)
+            self.update_fb_parameters(n_lines=int(value))
 
         def update_fb_center(value, old_value, **kwargs):
-            self.center = float(value)
-            self.pid.SetPoint = self.center
+            self.update_fb_parameters(center=float(value))
 
         def update_fb_line(value, old_value, **kwargs):
-            self.line = int(value)
+            self.update_fb_parameters(line=int(value))
 
         def update_fb_status(value, old_value, **kwargs):
-            self.status = bool(value)
+            self.update_fb_parameters(status=bool(value))
 
         def update_host(value, old_value, **kwargs):
-            self.host = str(value)
+            self.update_fb_parameters(host=str(value))
 
         self.hhm.fb_pcoeff.subscribe(update_fb_kp)
         self.hhm.fb_nmeasures.subscribe(update_fb_nmeasures)
@@ -106,6 +223,276 @@ class PiezoFeedback:
         self.hhm.fb_status.subscribe(update_fb_status)
         self.hhm.fb_hostname.subscribe(update_host)
 
+    def publish_frames(self, name=None, **kwargs):
+        # publish the frame band, profile and fit result of every iteration for local consumers, in a ring
+        # named after the camera by default, see frame_buffer.frame_ring_name and SharedFrameRingReader
+        if name is None:
+            name = frame_ring_name(self.bpm_es.name)
+        self.stop_publishing_frames()
+        self.frame_ring = SharedFrameRing(name=name, max_rows=self.image_size_y, **kwargs)
+
+    def stop_publishing_frames(self):
+        if self.frame_ring is not None:
+            frame_ring, self.frame_ring = self.frame_ring, None
+            frame_ring.close()
+
+    def use_stats_centroid(self, stats=None, roi=None, centroid_threshold=10):
+        # lightweight mode: the camera IOC computes the centroid of the feedback band (ROI plugin -> Stats
+        # plugin) and the loop only subscribes to the centroid. No frame is transferred or fitted.
+        # The centroid is not the Gaussian center of the fit, so the loop would steer the beam elsewhere: switch
+        # with the feedback off and update the fb_center before turning it on again.
+        # stats2/roi2 by default, stats1/roi1 feed BPM.image_centroid_y and adjust_camera_exposure_time; the
+        # plugin settings are put back by use_image_analysis.
+        self.check_feedback_off("switching to the stats centroid")
+        self.use_image_analysis()
+        self._stats = stats if stats is not None else self.bpm_es.stats2
+        self._stats_roi = roi if roi is not None else self.bpm_es.roi2
+        self._stats_threshold = centroid_threshold
+        self._stats_band_key = None
+        self._centroid = None
+        self._centroid_event = threading.Event()
+
+        def update_centroid(value, timestamp=None, **kwargs):
+            self._centroid = (value, timestamp)
+            self._centroid_event.set()
+
+        self._centroid_cid = self._stats.centroid.y.subscribe(update_centroid, run=False)
+        self.position_source = "stats"
+
+    def use_ioc_binning(self, roi=None, image_plugin=None):
+        # the ROI plugin sums the band on the IOC into a 1 pixel wide strip and the image plugin is fed from the
+        # ROI, so only the summed profile crosses the network. roi2 by default, roi1 feeds stats1 (see
+        # use_stats_centroid). The image plugin (image1 by default, pass a spare one if the IOC has it) shows
+        # the strip while this mode is on; use_image_analysis puts all the plugin settings back.
+        self.use_image_analysis()
+        self._binning_roi = roi if roi is not None else self.bpm_es.roi2
+        self._profile_plugin = image_plugin if image_plugin is not None else self.bpm_es.image
+        self._profile_source = FastSignal(self._profile_plugin.array_data, count=self.image_size_y)
+        self._binning_band_key = None
+        self.position_source = "profile"
+
+    def use_image_analysis(self):
+        if self.position_source == "stats":
+            self.check_feedback_off("switching from the stats centroid")
+            self._stats.centroid.y.unsubscribe(self._centroid_cid)
+        self.restore_plugin_config()
+        self.position_source = "image"
+        # the freeze detection starts over, the frames of the other sources have another shape
+        self.previous_image = None
+        self.previous_image_age = None
+
+    def check_feedback_off(self, action):
+        # for the changes that move the measured beam position, which the fb_center has to follow
+        if self.feedback_on and self.local_hosting:
+            raise RuntimeError(f"Turn off the feedback before {action}, then update the fb_center")
+
+    def put_plugin_setting(self, signal, value):
+        # the original value of every plugin setting changed for the IOC-side sources is kept, so that the
+        # plugins can be handed back to the GUIs and diagnostics as they were, see restore_plugin_config
+        if signal not in self._plugin_config:
+            self._plugin_config[signal] = signal.get()
+        signal.put(value)
+
+    def restore_plugin_config(self):
+        # in the reverse order of the changes, so the plugins are disconnected before their inputs change
+        for signal, value in reversed(list(self._plugin_config.items())):
+            signal.put(value)
+        self._plugin_config = {}
+
+    def configure_binning_roi(self, parameters):
+        band, _ = self.band_for(parameters)
+        width = band.stop - max(band.start, 0)
+        roi = self._binning_roi
+        self.put_plugin_setting(roi.nd_array_port, self.bpm_es.cam.port_name.get())
+        self.put_plugin_setting(roi.min_xyz.min_x, max(band.start, 0))
+        self.put_plugin_setting(roi.size.x, width)
+        self.put_plugin_setting(roi.bin_.x, width)
+        self.put_plugin_setting(roi.min_xyz.min_y, 0)
+        self.put_plugin_setting(roi.size.y, self.image_size_y)
+        self.put_plugin_setting(roi.bin_.y, 1)
+        self.put_plugin_setting(roi.data_type_out, "Float64")  # the binned band overflows the camera data type
+        self.put_plugin_setting(roi.enable_scale, 0)
+        self.put_plugin_setting(roi.enable, 1)
+        self.put_plugin_setting(self._profile_plugin.nd_array_port, roi.port_name.get())
+        self.put_plugin_setting(self._profile_plugin.enable, 1)
+
+    def take_profile(self, parameters, out=None, background=None):
+        key = (parameters.line, parameters.n_lines)
+        try:
+            if key != self._binning_band_key:
+                self.configure_binning_roi(parameters)
+                self._binning_band_key = key
+            if self.triggered_acquisition and not self.trigger_frame():
+                return None, "trigger timeout"
+            beam_profile, self.image_timestamp = self._profile_source.get_with_timestamp()
+            if self.triggered_acquisition and (self._unique_id != self._expected_unique_id):
+                return None, "stale frame"
+            beam_profile, err_msg = self.check_image(beam_profile[: self.image_size_y])
+            if beam_profile is not None and self.frame_is_stale():
+                return None, self.stale_frame_msg()
+        except Exception as e:
+            if self.should_print_diagnostics:
+                print_msg_now(f"Exception: {e}\nCould not read the binned beam profile from the camera IOC.")
+            return None, "network"
+        if beam_profile is None:
+            return None, err_msg
+        if out is None:
+            out = np.empty(beam_profile.size)
+        out[:] = beam_profile
+        if background is None:
+            return subtract_background(out), err_msg
+        out -= background
+        return out, err_msg
+
+    def configure_stats_roi(self, parameters):
+        band, _ = self.band_for(parameters)
+        roi, stats = self._stats_roi, self._stats
+        self.put_plugin_setting(roi.nd_array_port, self.bpm_es.cam.port_name.get())
+        self.put_plugin_setting(roi.min_xyz.min_x, max(band.start, 0))
+        self.put_plugin_setting(roi.size.x, band.stop - max(band.start, 0))
+        self.put_plugin_setting(roi.min_xyz.min_y, 0)
+        self.put_plugin_setting(roi.size.y, self.image_size_y)
+        self.put_plugin_setting(roi.enable, 1)
+        self.put_plugin_setting(stats.nd_array_port, roi.port_name.get())
+        self.put_plugin_setting(stats.compute_statistics, "Yes")
+        self.put_plugin_setting(stats.compute_centroid, "Yes")
+        self.put_plugin_setting(stats.centroid_threshold, self._stats_threshold)
+        self.put_plugin_setting(stats.enable, 1)
+
+    def read_stats_centroid(self, parameters, timeout=1):
+        key = (parameters.line, parameters.n_lines)
+        if key != self._stats_band_key:
+            self.configure_stats_roi(parameters)
+            self._stats_band_key = key
+            self._centroid_event.clear()  # centroids of the previous band are stale
+        if not self._centroid_event.wait(timeout):
+            return None, "no centroid"
+        self._centroid_event.clear()
+        centroid_y, self.image_timestamp = self._centroid
+        if self.frame_is_stale():
+            return None, self.stale_frame_msg()
+
+        self.peak_counts = self._stats.max_value.get()
+        image_quality = check_stats_quality(self.peak_counts, self._stats.min_value.get())
+        if image_quality != "good":
+            if self.should_print_diagnostics:
+                print_msg_now("Feedback error: image is either empty or saturated")
+            return None, f"{image_quality} image"
+        # same coordinates as the fit in analyze_profile, which counts the rows from the bottom of the image
+        return self.image_size_y - 1 - centroid_y, ""
+
+    def use_fast_signals(self):
+        # read the per-frame PVs through pyepics directly instead of ophyd's read()
+        self.image_source = FastSignal(self.bpm_es.image.array_data, count=self.image_size_x * self.image_size_y)
+        self.pitch_readback = FastSignal(self.hhm.pitch.user_readback, monitor=True)
+
+    def use_pva_frames(self, pvname, **kwargs):
+        # read the frames from the camera's NDPluginPva output (optionally lz4/blosc compressed by NDPluginCodec)
+        # instead of the Channel Access waveform
+        self.image_source = PVAFrameSource(pvname, **kwargs)
+
+    def use_triggered_acquisition(self, timeout=2):
+        # the camera only takes a frame when the loop asks for one, i.e. after the previous pitch move is done
+        self._trigger_timeout = timeout
+        self._frame_condition = threading.Condition()
+        self._unique_id = self.bpm_es.image.unique_id.get()
+
+        def update_unique_id(value, **kwargs):
+            with self._frame_condition:
+                self._unique_id = value
+                self._frame_condition.notify_all()
+
+        self._unique_id_cid = self.bpm_es.image.unique_id.subscribe(update_unique_id, run=False)
+        self.bpm_es.acquire.put(0)
+        self.bpm_es.cam.image_mode.put(0)  # Single
+        self.triggered_acquisition = True
+
+    def use_free_running_acquisition(self):
+        if self.triggered_acquisition:
+            self.bpm_es.image.unique_id.unsubscribe(self._unique_id_cid)
+            self.triggered_acquisition = False
+        self.bpm_es.cam.image_mode.put(2)  # Continuous
+        self.bpm_es.acquire.put(1)
+
+    def trigger_frame(self):
+        # fires one acquisition and waits until the image plugin has got exactly that frame
+        with self._frame_condition:
+            self._expected_unique_id = self._unique_id + 1
+        self.bpm_es.acquire.put(1)
+        with self._frame_condition:
+            return self._frame_condition.wait_for(
+                lambda: self._unique_id >= self._expected_unique_id, timeout=self._trigger_timeout
+            )
+
+    def use_move_coalescing(self, stats_signal=None, **kwargs):
+        # suppress pitch corrections within the centroid noise and merge them until they are significant; the
+        # moves issued/suppressed are published every motion_stats_period to stats_signal (e.g. a string PV)
+        self.move_coalescer = MoveCoalescer(**kwargs)
+        self.motion_stats_signal = stats_signal
+
+    def use_exposure_control(self, **kwargs):
+        # adjust the camera exposure from the analyzed frames to keep the beam in the good dynamic range,
+        # see exposure.ExposureController
+        self.exposure_controller = ExposureController(self.bpm_es.cam.acquire_time, **kwargs)
+
+    def stop_exposure_control(self):
+        self.exposure_controller = None
+
+    def control_exposure(self, err_msg):
+        if self.exposure_controller is not None:
+            self.exposure_controller.update(
+                err_msg, self.peak_counts, self.image_timestamp, exp_time=self.exposure_time
+            )
+
+    def use_position_estimator(self, plant_gain=None, **kwargs):
+        # feed the PID with the Kalman filtered beam position instead of the single frame fits, see
+        # estimators.KalmanPositionEstimator. The plant gain defaults to the loaded calibration.
+        if plant_gain is None and self.calibration is not None:
+            plant_gain = self.calibration["plant_gain"]
+        self.position_estimator = KalmanPositionEstimator(plant_gain=plant_gain, **kwargs)
+
+    def use_raw_positions(self):
+        self.position_estimator = None
+
+    def use_outlier_rejection(self, **kwargs):
+        # skip the centroids that are inconsistent with the recent ones (e.g. a bad fit of a partially saturated
+        # frame) instead of moving the pitch, see estimators.HampelFilter
+        self.outlier_filter = HampelFilter(**kwargs)
+
+    def stop_outlier_rejection(self):
+        self.outlier_filter = None
+
+    def is_outlier(self, beam_position):
+        return (self.outlier_filter is not None) and not self.outlier_filter.accept(beam_position)
+
+    def estimate_position(self, beam_position):
+        if self.position_estimator is None:
+            return beam_position
+        return self.position_estimator.update(
+            beam_position,
+            self.image_timestamp,
+            variance=self.position_variance,
+            pitch=self.pitch_readback.get(),
+        )
+
+    def report_motion_stats(self):
+        if self.move_coalescer is None:
+            return
+        now = ttime.time()
+        if (now - self._motion_stats_start) > self.motion_stats_period:
+            stats = self.move_coalescer.stats
+            msg = (
+                f"Pitch moves issued: {stats['moves_issued']}, suppressed: {stats['moves_suppressed']}, "
+                f"centroid noise: {stats['noise']:.3f} px"
+            )
+            print_msg_now(msg)
+            if self.motion_stats_signal is not None:
+                try:
+                    self.motion_stats_signal.put(msg)
+                except Exception as e:
+                    print_msg_now(f"Could not publish the motion stats: {e}")
+            self._motion_stats_start = now
+
     def tweak_fb_center(self, shift=1):
         cur_value = self.center
         self.hhm.fb_center.put(cur_value + shift)
@@ -130,6 +517,30 @@ class PiezoFeedback:
         self.shutters["FE Shutter"].state.subscribe(update_fe_shutter)
         self.shutters["PH Shutter"].state.subscribe(update_ph_shutter)
 
+    def subscribe_exposure_time(self):
+        def update_exposure_time(value, old_value, **kwargs):
+            self.exposure_time = float(value)
+
+        self.bpm_es.cam.acquire_time.subscribe(update_exposure_time)
+
+    def frame_is_stale(self):
+        # image_timestamp is the IOC time of the frame, i.e. the end of the exposure (+ readout)
+        if self._move_done is None or self.image_timestamp is None:
+            return False
+        stale = (self.image_timestamp - self.exposure_time) < (self._move_done + self.settle_time)
+        if stale:
+            self.n_stale_frames += 1
+            if self._stale_since is None:
+                self._stale_since = ttime.time()
+        else:
+            self._stale_since = None
+        return stale
+
+    def stale_frame_msg(self):
+        if (ttime.time() - self._stale_since) > self.stale_timeout:
+            return "no fresh frame"
+        return "stale frame"  # skipped silently, the next frame is exposed after the move
+
     def check_image(self, image):
         err_msg = ""
         if self.previous_image is not None:
@@ -153,9 +564,22 @@ class PiezoFeedback:
 
     def take_image(self):
         try:
-            image = self.bpm_es.image.array_data.read()["bpm_es_image_array_data"]["value"].reshape((960, 1280))
+            if self.triggered_acquisition and not self.trigger_frame():
+                return None, "trigger timeout"
+            if self.image_source is None:
+                array_data = self.bpm_es.image.array_data
+                reading = array_data.read()[array_data.name]
+                image, self.image_timestamp = reading["value"], reading["timestamp"]
+            else:
+                image, self.image_timestamp = self.image_source.get_with_timestamp()
+            if self.triggered_acquisition and (self._unique_id != self._expected_unique_id):
+                return None, "stale frame"
+            image = image.reshape((self.image_size_y, self.image_size_x))
             image = image.astype(np.int16)
+            # before the stale frame check, a frozen camera only delivers stale frames
             image, err_msg = self.check_image(image)
+            if image is not None and self.frame_is_stale():
+                return None, self.stale_frame_msg()
         except Exception as e:
             if self.should_print_diagnostics:
                 print_msg_now(
@@ -165,30 +589,182 @@ class PiezoFeedback:
             image, err_msg = None, "network"
         return image, err_msg
 
-    def find_beam_position(self):
+    def _analyze(self, fn, data, **kwargs):
+        if self.analysis_executor is None:
+            return fn(data, **kwargs)
+        return self.analysis_executor.submit(fn, data, **kwargs).result()
+
+    def band_for(self, parameters):
+        # band slice and profile buffer only change together with line/n_lines
+        key = (parameters.line, parameters.n_lines)
+        if key != self._band_key:
+            self._band = band_slice(parameters.line, parameters.n_lines)
+            self._profile_buffer = np.empty(self.image_size_y)
+            self._band_key = key
+        return self._band, self._profile_buffer
+
+    def read_profile(self, parameters, background=None):
+        # (image, background subtracted band profile, err_msg); image is None for the IOC binned profiles
+        band, profile_buffer = self.band_for(parameters)
+        if self.position_source == "profile":
+            beam_profile, err_msg = self.take_profile(parameters, out=profile_buffer, background=background)
+            return None, beam_profile, err_msg
         image, err_msg = self.take_image()
+        beam_profile = None
         if image is not None:
-            beam_position, err_msg = analyze_image(
-                image,
-                line=self.line,
-                center=self.center,
-                n_lines=self.n_lines,
-                truncate_data=self.truncate_data,
-                should_print_diagnostics=self.should_print_diagnostics,
+            beam_profile = reduce_image(
+                image, parameters.line, parameters.n_lines, band=band, out=profile_buffer, background=background
             )
+        return image, beam_profile, err_msg
+
+    def use_dark_model(self, **kwargs):
+        # subtract the dark profile learned while the shutters are closed instead of the mean of the first 200
+        # pixels of every profile, see image_processing.DarkModel and update_dark_model
+        self.dark_model = DarkModel(**kwargs)
+
+    def stop_dark_model(self):
+        self.dark_model = None
+
+    def update_dark_model(self):
+        # adds the current frame to the dark model, the loop calls it while the shutters are closed
+        if self.position_source == "stats":
+            return  # the IOC computes the centroid, there is no profile to correct
+        parameters = self.parameters
+        _, dark_profile, _ = self.read_profile(parameters, background=0.0)
+        if dark_profile is not None:
+            self.dark_model.add(dark_profile, self.dark_key(parameters))
+
+    def dark_key(self, parameters):
+        # the dark level depends on the exposure time as well as on the band, the exposure controller and
+        # optimize_acquisition change it while the feedback runs
+        return parameters.line, parameters.n_lines, self.exposure_time
+
+    def use_cross_correlation(self):
+        # find the beam position by cross-correlation with a reference profile instead of the Gaussian fit,
+        # see image_processing.CrossCorrelationEstimator; the reference is taken from the next frame
+        self.position_engine = CrossCorrelationEstimator()
+        self.retake_reference_profile()
+
+    def use_gaussian_fit(self):
+        self.position_engine = None
+
+    def retake_reference_profile(self):
+        # e.g. after the beam profile changed shape; the reference is taken from the next frame
+        self._reference_key = None
+
+    def set_reference_profile(self, beam_profile, parameters):
+        # the reference position is the Gaussian fit of the reference profile, so the positions stay comparable
+        # with the fitted ones; a profile that cannot be fitted is not taken as the reference
+        reference_position, _ = analyze_profile(
+            beam_profile.copy(), n_lines=parameters.n_lines, truncate_data=False, should_print_diagnostics=False
+        )
+        if reference_position is None:
+            return
+        self.position_engine.set_reference(beam_profile.copy(), reference_position)
+        self._reference_key = (parameters.line, parameters.n_lines)
+
+    def find_beam_position(self, parameters=None):
+        if parameters is None:
+            parameters = self.parameters
+        if self.position_source == "stats":
+            self.position_variance = None
+            beam_position, err_msg = self.read_stats_centroid(parameters)
+            self.control_exposure(err_msg)
             return beam_position, err_msg
-        else:
+        background = None
+        if self.dark_model is not None:
+            background = self.dark_model.background(self.dark_key(parameters))
+        image, beam_profile, err_msg = self.read_profile(parameters, background=background)
+        if beam_profile is None:
             return None, err_msg
 
+        self.peak_counts = beam_profile.max() / parameters.n_lines
+        frame_ring = self.frame_ring
+        if frame_ring is not None:
+            slot = frame_ring.begin_write(
+                image, beam_profile, parameters.line, parameters.n_lines, self.image_timestamp
+            )
+        if self.position_engine is None:
+            engine = analyze_profile
+        else:
+            if (parameters.line, parameters.n_lines) != self._reference_key:
+                self.set_reference_profile(beam_profile, parameters)
+            engine = self.position_engine.analyze_profile
+        beam_position, err_msg, self.position_variance = self._analyze(
+            engine,
+            beam_profile,
+            n_lines=parameters.n_lines,
+            truncate_data=self.truncate_data,
+            should_print_diagnostics=self.should_print_diagnostics,
+            return_variance=True,
+            fit_saturated=self.fit_saturated,
+            fit_window_sigmas=self.fit_window_sigmas,
+            coarse_binning=self.coarse_binning,
+        )
+        if frame_ring is not None:
+            frame_ring.end_write(slot, beam_position, err_msg)
+        self.control_exposure(err_msg)
+        return beam_position, err_msg
+
+    def measure_positions_batch(self, parameters):
+        # reads the n_measures profiles first and fits them together, see image_processing.fit_gauss_batch. Every
+        # frame feeds the exposure controller and, after the fit, the frame ring as in find_beam_position
+        background = None
+        if self.dark_model is not None:
+            background = self.dark_model.background(self.dark_key(parameters))
+        profiles, frames, err_msg = [], [], ""
+        for i in range(parameters.n_measures):
+            image, beam_profile, err_msg = self.read_profile(parameters, background=background)
+            if beam_profile is None:
+                continue
+            beam_profile = beam_profile.copy()  # the profile buffer is reused by the next read
+            self.peak_counts = beam_profile.max() / parameters.n_lines
+            image_quality = check_image_quality(beam_profile, parameters.n_lines)
+            frame_msg = "" if image_quality == "good" else f"{image_quality} image"
+            self.control_exposure(frame_msg)
+            if self.frame_ring is not None:
+                index = len(profiles) if image_quality == "good" else None
+                frames.append((image, beam_profile, self.image_timestamp, index, frame_msg))
+            if image_quality != "good":
+                err_msg = frame_msg
+                continue
+            profiles.append(beam_profile)
+        centers, variances = [], []
+        if len(profiles) > 0:
+            coeff, converged, variances = fit_gauss_batch(np.array(profiles), return_variance=True)
+            if not converged.all():
+                err_msg = "fitting"
+            centers, variances = list(coeff[converged, 1]), list(variances[converged])
+        for image, beam_profile, timestamp, index, frame_msg in frames:
+            position = None
+            if index is not None:
+                position, frame_msg = (coeff[index, 1], "") if converged[index] else (None, "fitting")
+            slot = self.frame_ring.begin_write(image, beam_profile, parameters.line, parameters.n_lines, timestamp)
+            self.frame_ring.end_write(slot, position, frame_msg)
+        return centers, variances, err_msg
+
     def update_center(self):
-        centers = []
-        for i in range(self.n_measures):
-            current_position, err_msg = self.find_beam_position()
-            if current_position is not None:
-                centers.append(current_position)
+        parameters = self.parameters
+        if self.position_source != "stats" and self.position_engine is None and not self.fit_saturated:
+            centers, variances, err_msg = self.measure_positions_batch(parameters)
+        else:
+            centers, variances = [], []
+            for i in range(parameters.n_measures):
+                current_position, err_msg = self.find_beam_position(parameters)
+                if current_position is not None:
+                    centers.append(current_position)
+                    variances.append(self.position_variance)
+
+        if (self.outlier_filter is not None) and (len(centers) > 0):
+            inliers = robust_inliers(centers, n_sigma=self.outlier_filter.n_sigma)
+            centers = [center for center, inlier in zip(centers, inliers) if inlier]
+            variances = [variance for variance, inlier in zip(variances, inliers) if inlier]
 
         if len(centers) > 0:
-            center_av = np.mean(centers)
+            if all((variance is not None) and (variance > 0) for variance in variances):
+                center_av = np.average(centers, weights=1 / np.array(variances))
+            else:
+                center_av = np.mean(centers)
             self.hhm.fb_center.put(
                 center_av
             )  # this should automatically update the self.center and self.pid.SetPoint due to subscription
@@ -196,28 +772,74 @@ class PiezoFeedback:
         else:
             self.report_fb_error(err_msg)
 
+    def pitch_target(self, center_rb, parameters, centroid=None):
+        # None if the correction is suppressed by the move coalescer. centroid is the unfiltered beam position
+        # for the noise estimate of the move coalescer, if center_rb is filtered (see estimate_position)
+        self.apply_pid_parameters(parameters)
+        self.pid.update(center_rb, current_time=self.image_timestamp)
+        pitch_delta = self.pid.output
+        if self.move_coalescer is not None:
+            if centroid is None:
+                centroid = center_rb
+            pitch_delta = self.move_coalescer.coalesce(
+                centroid, pitch_delta, self.pid.Kp, timestamp=self.image_timestamp
+            )
+        pitch_current = self.pitch_readback.get()
+        pitch_target = None if pitch_delta is None else pitch_current + pitch_delta
+        if self.history is not None:
+            if pitch_target is not None:
+                # random +-dither offset of the pitch, changed with every move
+                dither_offset = self.dither * self._dither_rng.choice((-1.0, 1.0))
+                pitch_target += dither_offset - self._dither_offset
+                self._dither_offset = dither_offset
+            if pitch_target is not None or self._pitch_command is None:
+                self._pitch_command = pitch_current if pitch_target is None else pitch_target
+            self.history.append(
+                self.image_timestamp,
+                center_rb,
+                parameters.center,
+                self._pitch_command,
+                pitch_current,
+                self._dither_offset,
+            )
+        return pitch_target
+
+    def pitch_target_for(self, beam_position, parameters):
+        # pitch target for a fitted beam position, see estimate_position and pitch_target
+        return self.pitch_target(self.estimate_position(beam_position), parameters, centroid=beam_position)
+
+    def move_pitch(self, pitch_target):
+        self._move_issued = ttime.time()
+        self.hhm.pitch.move(pitch_target)
+        self._move_done = ttime.time()
+
     def adjust_pitch(self):
         # print('attempting to adjust pitch', end= ' ... ')
-        center_rb, err_msg = self.find_beam_position()
+        parameters = self.parameters
+        center_rb, err_msg = self.find_beam_position(parameters)
+        if err_msg == "stale frame":
+            return True  # not an error, the next frame will be exposed after the move
+        if (center_rb is not None) and self.is_outlier(center_rb):
+            return True  # a single bad centroid, not worth a pitch move
         adjustment_success = False
         if center_rb is not None:
-            self.pid.update(center_rb)
-            pitch_delta = self.pid.output
-            pitch_current = self.hhm.pitch.user_readback.get()
-            pitch_target = pitch_current + pitch_delta
+            pitch_target = self.pitch_target_for(center_rb, parameters)
             try:
-                if pitch_target > 100:
-                    self.hhm.pitch.move(pitch_target)
-                self.should_print_diagnostics = True
+                if (pitch_target is not None) and (pitch_target > 100):
+                    self.move_pitch(pitch_target)
                 adjustment_success = True
-                self.report_no_fb_error()
             except Exception:
-                self.should_print_diagnostics = False
-                self.report_fb_error(err_msg)
+                pass
+        self.report_adjustment(adjustment_success, err_msg)
+        return adjustment_success
+
+    def report_adjustment(self, adjustment_success, err_msg):
+        if adjustment_success:
+            self.should_print_diagnostics = True
+            self.report_no_fb_error()
         else:
             self.should_print_diagnostics = False
             self.report_fb_error(err_msg)
-        return adjustment_success
 
     def report_fb_error(self, err_msg):
         self.hhm.fb_status_err.put(1)
@@ -227,21 +849,20 @@ class PiezoFeedback:
         self.hhm.fb_status_err.put(0)
         self.hhm.fb_status_msg.put("")
 
-    # def update_deviation_data(self, timestamp, center, pitch):
-    #     self._timestamps = self._update_finite_array(self._timestamps, timestamp, self._idx, self._n_max_data)
-    #     self._centers = self._update_finite_array(self._centers, center, self._idx, self._n_max_data)
-    #     self._pitch_vals = self._update_finite_array(self._pitch_vals, pitch, self._idx, self._n_max_data)
-    #     if self._idx < self._n_max_data:
-    #         self._idx += 1
-    #
-    #
-    # def _update_finite_array(self, x, new_value, idx, n_max):
-    #     if idx < n_max:
-    #         x[idx] = new_value
-    #     else:
-    #         x[:-1] = x[1:]
-    #         x[-1] = new_value
-    #     return x
+    def record_history(self, n_max=100000, dither=0.0):
+        # keep the time-aligned centroids, setpoints and pitch targets/readbacks of the last n_max iterations,
+        # e.g. for system_identification.identify_from_history(piezo_feedback.history). With the loop closed the
+        # pitch mostly follows the beam, so the recorded data only determine the plant if the loop is excited:
+        # dither (in pitch units) adds a known random offset to the pitch moves while recording.
+        self.history = FeedbackHistory(n_max)
+        self.dither = dither
+        self._dither_offset = 0.0
+
+    def stop_recording_history(self):
+        # the pitch keeps the last dither offset until the loop corrects it
+        self.history = None
+        self.dither = 0.0
+        self._dither_offset = 0.0
 
     @property
     def shutters_open(self):
@@ -282,25 +903,121 @@ class PiezoFeedback:
             # no heartbeat emitted is an indicator that something went wrong !
             pass
 
+    def step(self):
+        # one pass of the feedback loop; returns the time to wait before the next pass
+        if self.local_hosting:
+            self._start_timers()
+            if self.feedback_on and self.shutters_open:
+                adjustment_success = self.adjust_pitch()
+                if adjustment_success:
+                    delay = self.pid.sample_time
+                else:
+                    delay = 0.25
+            else:
+                if (self.dark_model is not None) and not self.shutters_open:
+                    self.update_dark_model()
+                delay = 0.25
+            if self.should_emit_heartbeat:
+                self.emit_heartbeat_signal()
+            self.report_motion_stats()
+        else:
+            delay = 1
+        return delay
+
     def run(self):
         while 1:
-            if self.local_hosting:
-                self._start_timers()
-                if self.feedback_on and self.shutters_open:
-                    adjustment_success = self.adjust_pitch()
-                    if adjustment_success:
-                        ttime.sleep(self.pid.sample_time)
-                    else:
-                        ttime.sleep(0.25)
-                else:
-                    ttime.sleep(0.25)
+            ttime.sleep(self.step())
+
+
+class FeedbackManager:
+    # Runs several camera/axis feedback loops in one process. All loops share the Channel Access
+    # context (and thus the connections) of the process, one thread pool for the image analysis and
+    # a single heartbeat. The heartbeat is only emitted while this machine hosts at least one of the loops
+    # and stops as soon as any of the loops dies. Pass analysis_executor
+    # (e.g. analysis_pool.SharedMemoryAnalysisExecutor) to analyze the frames in worker processes instead,
+    # so that the fits of the loops do not take turns on the GIL; it does not pay off for a single loop.
+    def __init__(self, feedbacks, heartbeat_signal=None, max_workers=None, analysis_executor=None):
+        self.feedbacks = list(feedbacks)
+        if heartbeat_signal is None:
+            heartbeat_signal = self.feedbacks[0].hhm.fb_heartbeat
+        self.heartbeat_signal = heartbeat_signal
+
+        n_feedbacks = len(self.feedbacks)
+        if analysis_executor is None:
+            analysis_executor = ThreadPoolExecutor(
+                max_workers=(max_workers or n_feedbacks), thread_name_prefix="fb_analysis"
+            )
+        self.analysis_executor = analysis_executor
+        self._loop_executor = ThreadPoolExecutor(max_workers=n_feedbacks, thread_name_prefix="fb_loop")
+        for feedback in self.feedbacks:
+            feedback.should_emit_heartbeat = False
+            feedback.analysis_executor = self.analysis_executor
+
+        self._stop_event = threading.Event()
+        self._loops = []
+        self._hb_step_start = None
+
+    def _run_feedback(self, feedback):
+        while not self._stop_event.is_set():
+            self._stop_event.wait(feedback.step())
+
+    @property
+    def loops_alive(self):
+        return (len(self._loops) > 0) and all(not loop.done() for loop in self._loops)
+
+    @property
+    def local_hosting(self):
+        # like the single loop, only the machine hosting (at least one of) the loops keeps the heartbeat alive
+        return any(feedback.local_hosting for feedback in self.feedbacks)
+
+    def emit_heartbeat_signal(self, thresh=0.7):
+        now = ttime.time()
+        if not self.local_hosting:
+            self._hb_step_start = None
+        elif self._hb_step_start is None:
+            self._hb_step_start = now
+        elif (now - self._hb_step_start) > thresh:
+            try:
+                self.heartbeat_signal.put(int(self.heartbeat_signal.get() == 0))
+            except Exception:
+                pass
+            self._hb_step_start = None
+
+    def report_status(self):
+        for feedback, loop in zip(self.feedbacks, self._loops):
+            if loop.done():
+                print_msg_now(f"Feedback loop for {feedback.bpm_es.name} stopped: {loop.exception()}")
+
+    def run(self, heartbeat_period=0.1):
+        self._stop_event.clear()
+        self._loops = [self._loop_executor.submit(self._run_feedback, feedback) for feedback in self.feedbacks]
+        try:
+            while self.loops_alive:
                 self.emit_heartbeat_signal()
-            else:
-                ttime.sleep(1)
+                ttime.sleep(heartbeat_period)
+            self.report_status()
+        finally:
+            self.stop()
+
+    def stop(self):
+        self._stop_event.set()
+        self._loop_executor.shutdown(wait=True)
+        self.analysis_executor.shutdown(wait=True)
 
 
 if __name__ == "__main__":
     exec(open(PATH + "mini_profile.py").read())
+    exec(open(PATH + "pid.py").read())
     exec(open(PATH + "image_processing.py").read())
-    piezo_feedback = PiezoFeedback(hhm, bpm_es, shutters, local_hostname="remote")  # noqa F821
+    exec(open(PATH + "frame_buffer.py").read())
+    exec(open(PATH + "fast_signals.py").read())
+    exec(open(PATH + "pva_source.py").read())
+    exec(open(PATH + "motion.py").read())
+    exec(open(PATH + "calibration.py").read())
+    exec(open(PATH + "history.py").read())
+    exec(open(PATH + "estimators.py").read())
+    exec(open(PATH + "exposure.py").read())
+    piezo_feedback = PiezoFeedback(
+        hhm, bpm_es, shutters, local_hostname="remote", calibration_file=CALIBRATION_FILE  # noqa F821
+    )
     piezo_feedback.run()
@@ -0,0 +1,81 @@
+import numpy as np
+
+try:
+    from p4p.client.thread import Context
+except ImportError:
+    Context = None
+
+try:
+    import lz4.block as lz4_block
+except ImportError:
+    lz4_block = None
+
+try:
+    import blosc
+except ImportError:
+    blosc = None
+
+# pvData ScalarType of the uncompressed array, which areaDetector stores in codec.parameters
+_scalar_type_dtypes = {
+    1: np.int8,
+    2: np.int16,
+    3: np.int32,
+    4: np.int64,
+    5: np.uint8,
+    6: np.uint16,
+    7: np.uint32,
+    8: np.uint64,
+    9: np.float32,
+    10: np.float64,
+}
+
+
+class PVAFrameSource:
+    # Reads the camera frames as NTNDArray over PV Access (NDPluginPva output), optionally compressed by
+    # NDPluginCodec with lz4 or blosc. The frames are decompressed into a buffer that is reused from frame to
+    # frame, so the returned array is only valid until the next call. Same get_with_timestamp() contract as
+    # fast_signals.FastSignal, so it can be used as PiezoFeedback.image_source.
+    def __init__(self, pvname, timeout=2, context=None):
+        if Context is None:
+            raise ImportError("p4p is required to read the camera frames over PV Access")
+        self.pvname = pvname
+        self.timeout = timeout
+        self.context = context if context is not None else Context("pva", nt=False)
+        self.unique_id = None
+        self._buffer = np.empty(0, dtype=np.uint8)
+
+    def _decompress(self, value):
+        data = value.value
+        codec = value.codec.name
+        if not codec:
+            return data
+
+        dtype = _scalar_type_dtypes[int(value.codec.parameters)]
+        nbytes = int(value.uncompressedSize)
+        if self._buffer.size < nbytes:
+            self._buffer = np.empty(nbytes, dtype=np.uint8)
+        buffer = self._buffer[:nbytes]
+
+        if codec == "blosc":
+            if blosc is None:
+                raise ImportError("python-blosc is required to decompress blosc frames")
+            blosc.decompress_ptr(memoryview(data), buffer.ctypes.data)
+        elif codec == "lz4":
+            if lz4_block is None:
+                raise ImportError("lz4 is required to decompress lz4 frames")
+            # python-lz4 cannot decompress into a given buffer, copy the block over
+            buffer[:] = np.frombuffer(lz4_block.decompress(data, uncompressed_size=nbytes), dtype=np.uint8)
+        else:
+            raise ValueError(f"Unsupported NTNDArray codec '{codec}'")
+        return buffer.view(dtype)
+
+    def get_with_timestamp(self):
+        value = self.context.get(self.pvname, timeout=self.timeout)
+        image = self._decompress(value)
+        shape = [dimension.size for dimension in value.dimension][::-1]
+        self.unique_id = int(value.uniqueId)
+        timestamp = value.timeStamp.secondsPastEpoch + 1e-9 * value.timeStamp.nanoseconds
+        return image.reshape(shape), timestamp
+
+    def close(self):
+        self.context.close()
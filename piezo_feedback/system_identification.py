@@ -0,0 +1,145 @@
+import numpy as np
+
+from piezo_feedback.calibration import recommend_gain
+from piezo_feedback.history import FeedbackHistory, load_history
+
+
+def _resample(timestamps, values, t_grid):
+    # zero-order hold (the last valid sample at or before each grid time), the same rule for all the signals so
+    # that they stay aligned sample by sample when the grid times fall just short of the timestamps
+    valid = np.isfinite(values)
+    idx = np.searchsorted(timestamps[valid], t_grid, side="right") - 1
+    return values[valid][np.maximum(idx, 0)]
+
+
+def _delay(u, y, max_lag):
+    # lag (in samples, with parabolic refinement) at which the increments of y follow those of u
+    du = np.diff(u) - np.mean(np.diff(u))
+    dy = np.diff(y) - np.mean(np.diff(y))
+    n = du.size
+    nfft = 1 << int(np.ceil(np.log2(2 * n)))
+    xcorr = np.fft.irfft(np.conj(np.fft.rfft(du, nfft)) * np.fft.rfft(dy, nfft), nfft)[: max_lag + 1]
+    xcorr = np.abs(xcorr)
+    k = int(np.argmax(xcorr))
+    if 0 < k < max_lag:
+        denominator = xcorr[k - 1] - 2 * xcorr[k] + xcorr[k + 1]
+        if denominator != 0:
+            return k + 0.5 * (xcorr[k - 1] - xcorr[k + 1]) / denominator
+    return float(k)
+
+
+def _welch(x, y, nperseg):
+    # averaged cross spectral density of x and y with half-overlapping Hann windowed segments
+    step = nperseg // 2
+    n_segments = (x.size - nperseg) // step + 1
+    idx = np.arange(nperseg)[None, :] + step * np.arange(n_segments)[:, None]
+    window = np.hanning(nperseg)
+    X = np.fft.rfft((x[idx] - x[idx].mean(axis=1, keepdims=True)) * window, axis=1)
+    Y = np.fft.rfft((y[idx] - y[idx].mean(axis=1, keepdims=True)) * window, axis=1)
+    return np.mean(np.conj(X) * Y, axis=0) / np.sum(window**2)
+
+
+def identify_plant(
+    timestamps,
+    pitch_targets,
+    pitch_readbacks,
+    centroids,
+    dither=None,
+    dt=None,
+    max_delay=1.0,
+    nperseg=256,
+    phase_margin=60,
+    kp_per_pcoeff=0.004,
+):
+    # Estimates the pitch -> beam position plant from closed loop data recorded by the feedback (see
+    # PiezoFeedback.record_history): static gain, dead times, frequency response, noise spectrum, and from
+    # those the achievable bandwidth and recommended loop period and gains. With the loop closed, the pitch
+    # follows the beam motion, so regressing the beam position on the pitch is biased; if the pitch was dithered
+    # while recording, the dither is uncorrelated with the beam motion and is used as the instrument instead.
+    # the same frame can be analyzed more than once when the loop is faster than the camera, keep the state after
+    # the last iteration on each frame
+    n_samples = len(timestamps)
+    timestamps, unique = np.unique(np.asarray(timestamps, dtype=float)[::-1], return_index=True)
+    unique = n_samples - 1 - unique  # np.unique returns the first occurrence
+    pitch_targets = np.asarray(pitch_targets, dtype=float)[unique]
+    pitch_readbacks = np.asarray(pitch_readbacks, dtype=float)[unique]
+    centroids = np.asarray(centroids, dtype=float)[unique]
+    if dt is None:
+        dt = float(np.median(np.diff(timestamps)))
+    t_grid = np.arange(timestamps[0], timestamps[-1], dt)
+    u_target = _resample(timestamps, pitch_targets, t_grid)
+    u = _resample(timestamps, pitch_readbacks, t_grid)
+    y = _resample(timestamps, centroids, t_grid)
+    excited = dither is not None and np.nanstd(dither) > 0
+    if excited:
+        z = _resample(timestamps, np.asarray(dither, dtype=float)[unique], t_grid)
+    else:
+        z = u
+
+    max_lag = max(int(max_delay / dt), 1)
+    actuator_delay = _delay(u_target, u, max_lag)
+    if excited:
+        delay = max(_delay(z, y, max_lag) - actuator_delay, 0.0)
+        actuator_lag = int(round(actuator_delay))
+    else:
+        delay = _delay(u, y, max_lag)
+        actuator_lag = 0
+    lag = int(round(delay))
+
+    # z[k] -> u[k + actuator_lag] -> y[k + actuator_lag + lag]
+    n = u.size - actuator_lag - lag
+    z_lagged = z[:n] - np.mean(z[:n])
+    u_lagged, y_lagged = u[actuator_lag : actuator_lag + n], y[actuator_lag + lag : actuator_lag + lag + n]
+    plant_gain = np.dot(z_lagged, y_lagged - y_lagged.mean()) / np.dot(z_lagged, u_lagged - u_lagged.mean())
+    residual = y_lagged - y_lagged.mean() - plant_gain * (u_lagged - u_lagged.mean())
+
+    nperseg = min(nperseg, u.size)
+    frequencies = np.fft.rfftfreq(nperseg, dt)
+    Pzz = _welch(z, z, nperseg).real
+    Pyy = _welch(y, y, nperseg).real
+    Pzu = _welch(z, u, nperseg)
+    Pzy = _welch(z, y, nperseg)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        transfer_function = Pzy / Pzu
+        coherence = np.abs(Pzy) ** 2 / (Pzz * Pyy)
+    noise_psd = 2 * dt * _welch(residual, residual, min(nperseg, residual.size)).real
+    noise_rms = float(np.std(residual))
+
+    # integrating loop (the correction is added to the pitch) with a dead time: the crossover frequency
+    # that leaves the requested phase margin is (90 deg - margin) / dead time
+    dead_time = max((actuator_delay + delay) * dt, dt)
+    bandwidth = np.deg2rad(90 - phase_margin) / dead_time / (2 * np.pi)
+    sample_time = max(dt, 1 / (10 * bandwidth))  # sampling faster than 10x the bandwidth only adds load
+    delay_samples = int(np.ceil(dead_time / sample_time))
+    kp = recommend_gain(plant_gain, delay_samples)
+    return {
+        "dt": dt,
+        "excited": bool(excited),
+        "plant_gain": float(plant_gain),
+        "dead_time": float(delay * dt),
+        "actuator_dead_time": float(actuator_delay * dt),
+        "frequencies": frequencies,
+        "transfer_function": transfer_function,
+        "coherence": coherence,
+        "noise_psd": noise_psd,
+        "noise_rms": noise_rms,
+        "bandwidth": float(bandwidth),
+        "recommended_sample_time": float(sample_time),
+        "recommended_kp": float(kp),
+        "recommended_pcoeff": float(kp / kp_per_pcoeff),
+    }
+
+
+def identify_from_history(history, **kwargs):
+    if isinstance(history, str):
+        history = load_history(history)
+    elif isinstance(history, FeedbackHistory):
+        history = history.get()
+    return identify_plant(
+        history["timestamp"],
+        history["pitch_target"],
+        history["pitch_readback"],
+        history["centroid"],
+        dither=history["dither"],
+        **kwargs,
+    )
@@ -0,0 +1,17 @@
+import importlib
+import sys
+import types
+
+import pytest
+
+
+@pytest.fixture
+def piezo_fb(monkeypatch):
+    # piezo_fb without mini_profile, which connects to the beamline devices on import
+    mini_profile = types.ModuleType("piezo_feedback.mini_profile")
+    mini_profile.print_msg_now = print
+    monkeypatch.setitem(sys.modules, "piezo_feedback.mini_profile", mini_profile)
+    monkeypatch.setattr(sys, "argv", sys.argv[:1])  # imported as a module, not run as a script
+    monkeypatch.delitem(sys.modules, "piezo_feedback.piezo_fb", raising=False)
+    monkeypatch.delitem(sys.modules, "piezo_feedback.async_fb", raising=False)
+    return importlib.import_module("piezo_feedback.piezo_fb")
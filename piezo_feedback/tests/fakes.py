@@ -0,0 +1,131 @@
+import time
+import types
+
+import numpy as np
+
+
+class FakeSignal:
+    # get/put/subscribe stand-in for the ophyd signals, records the puts
+    def __init__(self, value=0, read_only=False, name="fake_signal"):
+        self.name = self.pvname = name
+        self.value = value
+        self.timestamp = 0.0
+        self.read_only = read_only
+        self.puts = []
+        self._callbacks = {}
+
+    def get(self, **kwargs):
+        return self.value
+
+    def read(self):
+        return {self.name: {"value": self.value, "timestamp": self.timestamp}}
+
+    def put(self, value, **kwargs):
+        if self.read_only:
+            raise RuntimeError("read-only signal")
+        old_value, self.value = self.value, value
+        self.timestamp = time.time()
+        self.puts.append(value)
+        for callback in list(self._callbacks.values()):
+            callback(value=value, old_value=old_value, obj=self)
+
+    def subscribe(self, callback, run=True, **kwargs):
+        cid = max(self._callbacks, default=0) + 1
+        self._callbacks[cid] = callback
+        if run:
+            callback(value=self.value, old_value=None, obj=self)
+        return cid
+
+    def unsubscribe(self, cid):
+        self._callbacks.pop(cid, None)
+
+
+class FakeComponent(FakeSignal):
+    # a signal whose other attributes are FakeComponents too, e.g. for roi.min_xyz.min_x of an areaDetector plugin
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        component = FakeComponent()
+        setattr(self, name, component)
+        return component
+
+
+class FakeStatus:
+    success = True
+
+    def add_callback(self, callback):
+        callback(self)
+
+
+class FakeMotor:
+    def __init__(self, position=300.0):
+        self.user_readback = FakeSignal(position)
+        self.moves = []
+
+    def move(self, position, **kwargs):
+        self.moves.append(position)
+        self.user_readback.put(position)
+        return FakeStatus()
+
+    def set(self, position, **kwargs):
+        return self.move(position)
+
+
+def beam_image(position, shape=(960, 1280), amplitude=60, sigma=40):
+    # frame with a horizontal beam stripe at position, in the coordinates of the fit (rows counted from the end)
+    n_rows, n_cols = shape
+    rows = np.arange(n_rows)
+    profile = amplitude * np.exp(-((rows - (n_rows - 1 - position)) ** 2) / (2 * sigma**2))
+    return np.repeat(5 + profile[:, None], n_cols, axis=1).astype(np.int16)
+
+
+def make_devices(host="remote", image_shape=(960, 1280)):
+    # hhm, bpm_es and shutters with the signals PiezoFeedback uses
+    hhm = types.SimpleNamespace(name="hhm")
+    hhm.pitch = FakeMotor()
+    for name, value in dict(
+        fb_status=1,
+        fb_center=480.0,
+        fb_line=640,
+        fb_nlines=20,
+        fb_nmeasures=5,
+        fb_pcoeff=1.0,
+        fb_hostname=host,
+        fb_heartbeat=0,
+        fb_status_err=0,
+        fb_status_msg="",
+    ).items():
+        setattr(hhm, name, FakeSignal(value))
+
+    n_rows, n_cols = image_shape
+    cam = types.SimpleNamespace(
+        array_size=types.SimpleNamespace(array_size_x=FakeSignal(n_cols), array_size_y=FakeSignal(n_rows)),
+        acquire_time=FakeSignal(0.01),
+        acquire_period=FakeSignal(0.05),
+        image_mode=FakeSignal(2),
+        port_name=FakeSignal("CAM"),
+    )
+    image = types.SimpleNamespace(
+        array_data=FakeSignal(np.zeros(n_rows * n_cols, dtype=np.int16)),
+        array_counter=FakeSignal(0),
+        unique_id=FakeSignal(0),
+        nd_array_port=FakeSignal("CAM"),
+        enable=FakeSignal(1),
+    )
+    bpm_es = types.SimpleNamespace(
+        name="bpm_es",
+        cam=cam,
+        image=image,
+        acquire=FakeSignal(1),
+        acquiring=True,
+        frame_rate=FakeSignal(20.0, read_only=True),  # cam.ps_frame_rate, the measured frame rate
+    )
+    for name in ("roi1", "roi2", "stats1", "stats2"):
+        plugin = FakeComponent()
+        plugin.port_name.value = name.upper()
+        setattr(bpm_es, name, plugin)
+    shutters = {
+        "FE Shutter": types.SimpleNamespace(state=FakeSignal(0)),
+        "PH Shutter": types.SimpleNamespace(state=FakeSignal(0)),
+    }
+    return hhm, bpm_es, shutters
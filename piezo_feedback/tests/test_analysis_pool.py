@@ -0,0 +1,51 @@
+import time
+
+import numpy as np
+import pytest
+
+from piezo_feedback.analysis_pool import SharedMemoryAnalysisExecutor
+from piezo_feedback.image_processing import analyze_profile
+
+ANALYSIS = dict(n_lines=20, truncate_data=False, should_print_diagnostics=False, return_variance=True)
+
+
+def _profiles(n):
+    x = np.arange(960)[::-1]
+    rng = np.random.default_rng(0)
+    return [20 * (60 * np.exp(-((x - 470 - i) ** 2) / (2 * 40**2)) + rng.normal(0, 1, 960)) for i in range(n)]
+
+
+@pytest.fixture
+def pool():
+    pool = SharedMemoryAnalysisExecutor(max_workers=1, n_buffers=2)
+    yield pool
+    pool.shutdown()
+
+
+def test_results_are_those_of_the_loop_thread(pool):
+    profiles = _profiles(5)  # more than the buffers, each is reused once its result is back
+    futures = [pool.submit(analyze_profile, profile.copy(), **ANALYSIS) for profile in profiles]
+    for profile, future in zip(profiles, futures):
+        assert future.result() == pytest.approx(analyze_profile(profile.copy(), **ANALYSIS))
+
+
+def test_arrays_larger_than_the_buffers_are_refused(pool):
+    with pytest.raises(ValueError):
+        pool.submit(analyze_profile, np.zeros((960, 2)))
+
+
+def test_throughput_of_a_single_loop(pool):
+    # what analysis_pool documents: a single loop waiting for every result gets nothing from the pool
+    profiles = _profiles(50)
+    pool.submit(analyze_profile, profiles[0].copy(), **ANALYSIS).result()  # the worker is started
+
+    def fits_per_second(analyze):
+        t_start = time.perf_counter()
+        for profile in profiles:
+            analyze(profile.copy())
+        return len(profiles) / (time.perf_counter() - t_start)
+
+    in_thread = fits_per_second(lambda profile: analyze_profile(profile, **ANALYSIS))
+    in_pool = fits_per_second(lambda profile: pool.submit(analyze_profile, profile, **ANALYSIS).result())
+    print(f"analyze_profile: {in_thread:.0f} fits/s in the loop thread, {in_pool:.0f} fits/s through the pool")
+    assert 1 / in_pool < 0.005  # still well within the frame period of the loop
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from piezo_feedback.calibration import analyze_step_response, recommend_gain
+
+
+@pytest.mark.parametrize("delay_samples", [0, 1, 2, 3])
+def test_recommended_gain_converges_without_overshoot(delay_samples):
+    plant_gain = 120.0
+    kp = recommend_gain(plant_gain, delay_samples)
+    errors = [1.0] * (delay_samples + 1)
+    for _ in range(60):
+        errors.append(errors[-1] - plant_gain * kp * errors[-1 - delay_samples])
+    errors = np.array(errors)
+    assert np.all(errors >= 0) and np.all(np.diff(errors) <= 0)
+    assert errors[-1] < 1e-2
+    # a larger gain overshoots
+    errors = [1.0] * (delay_samples + 1)
+    for _ in range(60):
+        errors.append(errors[-1] - plant_gain * 1.5 * kp * errors[-1 - delay_samples])
+    assert min(errors) < 0
+
+
+def test_step_response_analysis():
+    plant_gain, latency, frame_period = 120.0, 0.035, 0.01
+    rng = np.random.default_rng(0)
+    steps, pitch = [], 300.0
+    for offset in [0, 0.1, 0, -0.1, 0, 0.1, 0, -0.1]:
+        previous_pitch, pitch = pitch, 300.0 + offset
+        t_move = 10.0 * len(steps)
+        timestamps = t_move + frame_period * np.arange(1, 100)
+        positions = np.where(timestamps - t_move < latency, previous_pitch, pitch) * plant_gain
+        positions += rng.normal(0, 0.1, timestamps.size)
+        steps.append({"pitch": pitch, "t_move": t_move, "samples": np.column_stack([timestamps, positions])})
+    result = analyze_step_response(steps)
+    assert result["plant_gain"] == pytest.approx(plant_gain, rel=1e-3)
+    assert result["latency"] == pytest.approx(latency, abs=frame_period)
+    assert result["frame_period"] == pytest.approx(frame_period)
+    assert result["noise"] == pytest.approx(0.1, rel=0.5)
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from piezo_feedback.estimators import HampelFilter, KalmanPositionEstimator, robust_inliers
+
+
+def test_kalman_averages_noise_and_follows_pitch_moves():
+    rng = np.random.default_rng(0)
+    estimator = KalmanPositionEstimator(process_noise=1.0, plant_gain=100.0)
+    estimates = []
+    for i in range(400):
+        pitch = 0.05 if i >= 200 else 0.0
+        position = 480 + 100 * pitch + rng.normal(0, 1)
+        estimates.append(estimator.update(position, 0.01 * i, variance=1.0, pitch=pitch))
+    estimates = np.array(estimates)
+    assert np.std(estimates[100:200] - 480) < 0.3
+    assert estimates[200] == pytest.approx(485, abs=1)
+    assert np.mean(estimates[300:]) == pytest.approx(485, abs=0.3)
+
+
+def test_kalman_measurement_variance_fallback():
+    estimator = KalmanPositionEstimator(measurement_variance=1.0)
+    estimator.update(0.0, 0.0)
+    assert estimator.position_variance == 1.0
+    assert estimator.update(2.0, 0.01, variance=None) == pytest.approx(1.0, abs=1e-3)
+
+
+def test_kalman_ignores_frames_analyzed_again():
+    estimator = KalmanPositionEstimator(measurement_variance=0.25)
+    estimator.update(480.0, 0.0)
+    estimator.update(481.0, 0.01)
+    position, variance = estimator.position, estimator.position_variance
+    for _ in range(20):
+        assert estimator.update(481.0, 0.01) == position
+    assert estimator.position_variance == variance
+
+
+def test_hampel_rejects_spikes_and_accepts_steps():
+    rng = np.random.default_rng(1)
+    hampel = HampelFilter()
+    positions = 480 + rng.normal(0, 0.5, 100)
+    positions[50] += 20
+    positions[70:] += 10
+    accepted = np.array([hampel.accept(position) for position in positions])
+    assert not accepted[50]
+    assert accepted[:50].mean() >= 0.95
+    assert accepted[85:].all()
+
+
+def test_robust_inliers():
+    assert list(robust_inliers([1.0, 1.1, 0.9, 1.0, 30.0])) == [True, True, True, True, False]
+    assert robust_inliers([1.0, 30.0]).all()
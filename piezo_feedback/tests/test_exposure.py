@@ -0,0 +1,79 @@
+import time
+import types
+
+import pytest
+
+from piezo_feedback.exposure import ExposureController, apply_acquisition, optimize_acquisition
+from piezo_feedback.pid import PID
+from piezo_feedback.tests.fakes import make_devices
+
+
+class _Signal:
+    def __init__(self, value):
+        self.value = value
+        self.n_gets = 0
+
+    def get(self):
+        self.n_gets += 1
+        return self.value
+
+    def put(self, value):
+        self.value = value
+
+
+def test_exposure_steps_towards_target_counts():
+    signal = _Signal(0.01)
+    controller = ExposureController(signal, target_counts=60, max_step=2)
+    assert controller.update("saturated image", 250, None) == pytest.approx(0.005)
+    assert controller.update("", 90, None) == pytest.approx(0.005 * 60 / 90)
+    assert controller.update("", 65, None) is None  # within the tolerance
+    assert controller.update("empty image", 0, None) == pytest.approx(0.005 * 60 / 90 * 2)
+    assert controller.update("fitting", 65, None) is None
+    assert signal.value == controller.exp_time
+
+
+def test_exposure_ignores_frames_exposed_before_the_adjustment():
+    signal = _Signal(0.01)
+    controller = ExposureController(signal, max_exp_time=0.015)
+    assert controller.update("empty image", 0, None) == pytest.approx(0.015)
+    assert controller.update("empty image", 0, controller._put_time) is None
+    assert controller.update("", 60, controller._put_time + 1) is None
+    assert controller._put_time is None
+
+
+def test_exposure_follows_the_tracked_exposure_time():
+    signal = _Signal(0.01)
+    controller = ExposureController(signal, target_counts=60)
+    signal.value = 0.02  # changed by hand
+    assert controller.update("", 30, None, exp_time=0.02) == pytest.approx(0.04)
+    assert controller.update("", 30, None) == pytest.approx(0.08)
+    assert signal.n_gets == 1  # only when the controller is made
+
+
+def test_acquisition_sets_the_acquire_period():
+    _, bpm_es, _ = make_devices()
+    feedback = types.SimpleNamespace(bpm_es=bpm_es, pid=PID(), exposure_controller=None)
+    apply_acquisition(feedback, {"frame_rate": 50.0, "sample_time": 0.004, "peak_counts": 20.0})
+    assert bpm_es.cam.acquire_period.puts == [pytest.approx(0.02)]
+    assert bpm_es.frame_rate.puts == []  # read-only
+    assert feedback.pid.sample_time == 0.004
+
+
+def test_failed_optimization_puts_the_exposure_back():
+    _, bpm_es, _ = make_devices()
+    feedback = types.SimpleNamespace(
+        bpm_es=bpm_es, feedback_on=False, exposure_controller=None, exposure_time=0.01, peak_counts=None
+    )
+
+    def find_beam_position():
+        feedback.image_timestamp = time.time() + 1
+        feedback.peak_counts = 60 * bpm_es.cam.acquire_time.get() / 0.01
+        if feedback.peak_counts < 30:  # no good frame at the shortened exposure
+            return None, "empty image"
+        return 480.0, ""
+
+    feedback.find_beam_position = find_beam_position
+    with pytest.raises(RuntimeError):
+        optimize_acquisition(feedback, n_frames=2, timeout=0.05)
+    assert bpm_es.cam.acquire_time.puts == [pytest.approx(0.0025), 0.01]
+    assert feedback.exposure_time == 0.01
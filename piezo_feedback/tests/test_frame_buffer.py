@@ -0,0 +1,61 @@
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from piezo_feedback.frame_buffer import SharedFrameRing, SharedFrameRingReader, frame_ring_name
+
+
+@pytest.fixture
+def ring_name(request):
+    return frame_ring_name(f"test_{request.node.name}")
+
+
+def test_reader_sees_the_latest_complete_slot(ring_name):
+    ring = SharedFrameRing(name=ring_name, n_slots=2, max_rows=16, max_cols=4)
+    reader = SharedFrameRingReader(ring_name)
+    try:
+        assert reader.read_latest() is None
+        image = np.arange(16 * 10, dtype=np.int16).reshape(16, 10)
+        for i in range(3):
+            slot = ring.begin_write(image + i, np.full(16, float(i)), 5, 4, 100.0 + i)
+            assert reader.latest_seq == i  # not visible before end_write
+            ring.end_write(slot, 7.5 + i, "")
+        frame = reader.read_latest()
+        assert frame["seq"] == 3
+        assert frame["timestamp"] == 102.0
+        assert frame["position"] == 9.5
+        assert np.array_equal(frame["band"], image[:, 3:7] + 2)
+        assert np.array_equal(frame["profile"], np.full(16, 2.0))
+        assert reader.is_valid(frame)
+        ring.end_write(ring.begin_write(None, np.zeros(16), 5, 4, 103.0), None, "fitting")
+        ring.end_write(ring.begin_write(None, np.zeros(16), 5, 4, 104.0), None, "fitting")
+        assert not reader.is_valid(frame)  # the slot was written again
+        frame = reader.read_latest()
+        assert np.isnan(frame["position"]) and frame["err_msg"] == "fitting" and frame["band"].shape == (16, 0)
+        del frame
+    finally:
+        reader.close()
+        ring.close()
+
+
+def test_live_ring_is_not_replaced(ring_name):
+    ring = SharedFrameRing(name=ring_name, max_rows=16)
+    try:
+        with pytest.raises(FileExistsError):
+            SharedFrameRing(name=ring_name, max_rows=16)
+        SharedFrameRing(name=frame_ring_name("test_other_camera"), max_rows=16).close()  # one ring per camera
+    finally:
+        ring.close()
+
+
+def test_ring_left_over_by_a_dead_writer_is_replaced(ring_name):
+    stale = SharedFrameRing(name=ring_name, max_rows=16)
+    dead_process = subprocess.Popen([sys.executable, "-c", ""])
+    dead_process.wait()
+    stale.header["pid"] = dead_process.pid
+    del stale.header, stale.slots
+    stale.shm.close()  # the writer is gone without unlinking
+    ring = SharedFrameRing(name=ring_name, max_rows=16)
+    ring.close()
@@ -0,0 +1,148 @@
+import numpy as np
+import pytest
+
+from piezo_feedback.image_processing import (
+    CrossCorrelationEstimator,
+    DarkModel,
+    analyze_profile,
+    fit_gauss_batch,
+    gauss,
+    gauss_jacobian,
+    subtract_background,
+)
+
+
+def _profile(center, amplitude, n_lines=20, clip=None, sigma=40, npts=960, seed=0):
+    # in the coordinates of the fit, which counts the rows from the end of the profile
+    x = np.arange(npts)[::-1]
+    profile = amplitude * np.exp(-((x - center) ** 2) / (2 * sigma**2))
+    if clip is not None:
+        profile = np.minimum(profile, clip)
+    return n_lines * (profile + np.random.default_rng(seed).normal(0, 1, npts))
+
+
+def test_saturated_profile_is_fitted_on_its_flanks():
+    profile = _profile(480.3, 400, clip=150)
+    assert analyze_profile(profile.copy(), n_lines=20, should_print_diagnostics=False) == (None, "saturated image")
+    position, err_msg = analyze_profile(profile, n_lines=20, should_print_diagnostics=False, fit_saturated=True)
+    assert err_msg == "saturated image"
+    assert position == pytest.approx(480.3, abs=0.2)
+
+
+def test_dark_model_is_learned_per_band():
+    dark = DarkModel(n_frames=4, min_frames=2)
+    dark.add(np.full(10, 2.0), (640, 20))
+    assert dark.background((640, 20)) is None
+    for value in (4.0, 6.0, 8.0, 10.0):
+        dark.add(np.full(10, value), (640, 20))
+    assert dark.background((640, 20)) == pytest.approx(np.full(10, 6.25))
+    assert dark.background((600, 20)) is None
+    dark.add(np.full(10, 1.0), (600, 20))
+    assert dark.n_added == 1
+
+
+def test_cross_correlation_follows_the_shift_of_the_reference():
+    estimator = CrossCorrelationEstimator()
+    assert estimator.analyze_profile(_profile(480, 60), n_lines=20, should_print_diagnostics=False) == (
+        None,
+        "no reference profile",
+    )
+    estimator.set_reference(_profile(480, 60), 480)
+    for center in (475.4, 480, 493.7):
+        position, err_msg = estimator.analyze_profile(
+            _profile(center, 60, seed=1), n_lines=20, should_print_diagnostics=False
+        )
+        assert err_msg == ""
+        assert position == pytest.approx(center, abs=0.5)
+
+
+def test_gauss_jacobian_matches_finite_differences():
+    x = np.linspace(0, 100, 50)
+    p = np.array([2.0, 47.0, 9.0])
+    numerical = np.column_stack([(gauss(x, *(p + h)) - gauss(x, *(p - h))) / 2e-6 for h in np.eye(3) * 1e-6])
+    assert gauss_jacobian(x, *p) == pytest.approx(numerical, abs=1e-6)
+
+
+def test_windowed_fit_matches_full_fit():
+    profile = _profile(455.2, 60)
+    full, _ = analyze_profile(profile.copy(), n_lines=20, truncate_data=False, should_print_diagnostics=False)
+    windowed, _ = analyze_profile(
+        profile, n_lines=20, truncate_data=False, should_print_diagnostics=False, fit_window_sigmas=4
+    )
+    assert windowed == pytest.approx(full, abs=0.05)
+
+
+def test_batch_fit_matches_curve_fit():
+    centers = [300.5, 480.3, 612.8]
+    profiles = np.array([_profile(center, 60, seed=i) for i, center in enumerate(centers)])
+    coeff, converged = fit_gauss_batch(profiles)
+    assert converged.all()
+    for profile, (amplitude, center, sigma) in zip(profiles, coeff):
+        position, _ = analyze_profile(
+            profile.copy(), n_lines=20, truncate_data=False, should_print_diagnostics=False, fit_window_sigmas=4
+        )
+        assert center == pytest.approx(position, abs=1e-3)
+        assert sigma == pytest.approx(40, abs=1)
+
+
+def test_batch_fit_converges_for_beams_near_the_edges():
+    # the beams next to the first 200 pixels pull the background estimate of subtract_background
+    centers = [20.0, 480.3, 780.0, 820.0, 860.0, 900.0, 930.0]
+    for sigma in (40, 80):
+        profiles = np.array(
+            [subtract_background(_profile(center, 60, sigma=sigma, seed=i)) for i, center in enumerate(centers)]
+        )
+        coeff, converged = fit_gauss_batch(profiles)
+        assert converged.all()
+        for profile, center in zip(profiles, coeff[:, 1]):
+            position, _ = analyze_profile(
+                profile.copy(),
+                n_lines=20,
+                truncate_data=False,
+                should_print_diagnostics=False,
+                fit_window_sigmas=4,
+            )
+            assert center == pytest.approx(position, abs=0.1)
+
+
+def test_coarse_to_fine_fit_matches_full_fit():
+    profile = _profile(455.2, 60)
+    full, _, full_variance = analyze_profile(
+        profile.copy(), n_lines=20, truncate_data=False, should_print_diagnostics=False, return_variance=True
+    )
+    refined, err_msg, variance = analyze_profile(
+        profile,
+        n_lines=20,
+        truncate_data=False,
+        should_print_diagnostics=False,
+        return_variance=True,
+        coarse_binning=4,
+    )
+    assert err_msg == ""
+    assert refined == pytest.approx(full, abs=0.1)
+    assert variance == pytest.approx(full_variance, rel=0.5)
+
+
+def test_coarse_to_fine_fit_falls_back_for_a_narrow_beam():
+    profile = _profile(457.5, 60, sigma=3)
+    full, _ = analyze_profile(
+        profile.copy(), n_lines=20, truncate_data=False, should_print_diagnostics=False, fit_window_sigmas=4
+    )
+    position, err_msg = analyze_profile(
+        profile,
+        n_lines=20,
+        truncate_data=False,
+        should_print_diagnostics=False,
+        fit_window_sigmas=4,
+        coarse_binning=4,
+    )
+    assert err_msg == ""
+    assert position == pytest.approx(full, abs=1e-3)
+
+
+def test_batch_fit_window_of_a_wide_beam_stays_within_the_profile():
+    profile = _profile(200.0, 60, sigma=150)
+    position, _ = analyze_profile(profile.copy(), n_lines=20, truncate_data=False, should_print_diagnostics=False)
+    coeff, converged = fit_gauss_batch(profile[None, :])
+    assert converged.all()
+    assert coeff[0, 1] == pytest.approx(position, abs=1e-3)  # no pixel counted twice
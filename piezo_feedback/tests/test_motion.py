@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from piezo_feedback.motion import MoveCoalescer
+
+
+def test_noise_is_estimated_from_successive_centroids():
+    rng = np.random.default_rng(0)
+    coalescer = MoveCoalescer(noise_window=200)
+    for centroid in 480 + rng.normal(0, 0.5, 2000):
+        coalescer.update_noise(centroid)
+    assert coalescer.noise == pytest.approx(0.5, rel=0.2)
+
+
+def test_small_corrections_are_merged_until_significant():
+    coalescer = MoveCoalescer(n_sigma=3, min_noise=1.0)
+    gain = 0.01  # deadband of 0.03 for a single correction, 0.03 / sqrt(n) for n merged ones
+    assert coalescer.coalesce(480.0, 0.012, gain) is None
+    assert coalescer.coalesce(480.0, 0.014, gain) is None
+    assert coalescer.coalesce(480.0, 0.016, gain) is None
+    assert coalescer.coalesce(480.0, 0.022, gain) == pytest.approx(0.016)  # mean of 4 > 0.03 / 2
+    assert coalescer.coalesce(480.0, 0.05, gain) == pytest.approx(0.05)
+    assert coalescer.stats["moves_issued"] == 2
+    assert coalescer.stats["moves_suppressed"] == 3
+
+
+def test_frames_analyzed_again_are_not_new_estimates():
+    coalescers = []
+    for n_reads in (1, 5):
+        coalescer = MoveCoalescer(noise_window=200)
+        rng = np.random.default_rng(0)
+        for i, centroid in enumerate(480 + rng.normal(0, 0.5, 1000)):
+            for _ in range(n_reads):
+                coalescer.coalesce(centroid, 480 - centroid, 1.0, timestamp=0.05 * i)
+        coalescers.append(coalescer)
+    assert coalescers[1].stats == coalescers[0].stats
@@ -0,0 +1,50 @@
+import pytest
+
+from piezo_feedback.pid import PID
+
+
+def test_proportional_output_and_timestamps():
+    pid = PID(0.5, 0, 0)
+    pid.SetPoint = 10
+    pid.setSampleTime(0.1)
+    assert pid.update(8, current_time=100.0) == pytest.approx(1.0)
+    assert pid.update(9, current_time=100.3) == pytest.approx(0.5)
+    assert pid.last_time == 100.3
+
+
+def test_integral_uses_frame_dt_and_windup_guard():
+    pid = PID(0, 1, 0)
+    pid.windup_guard = 0.5
+    pid.update(-1, current_time=0.0)
+    pid.update(-1, current_time=0.2)
+    assert pid.ITerm == pytest.approx(0.2)
+    for t in range(1, 10):
+        pid.update(-1, current_time=float(t))
+    assert pid.ITerm == pytest.approx(0.5)
+
+
+def test_frame_analyzed_again_is_not_integrated_again():
+    pid = PID(0.5, 1, 0)
+    pid.setSampleTime(0.1)
+    pid.update(-1, current_time=0.0)
+    output = pid.update(-1, current_time=0.2)
+    for _ in range(5):
+        assert pid.update(-1, current_time=0.2) == output
+    assert pid.ITerm == pytest.approx(0.3)
+
+
+def test_output_and_rate_limits():
+    pid = PID(1, 0, 0)
+    pid.output_limit = 2
+    assert pid.update(-5, current_time=0.0) == pytest.approx(2)
+    pid.rate_limit = 1
+    assert pid.update(5, current_time=1.0) == pytest.approx(1)
+
+
+def test_filtered_derivative_on_measurement():
+    pid = PID(0, 0, 1)
+    pid.derivative_filter = 1.0
+    pid.update(0, current_time=0.0)
+    pid.SetPoint = 100  # no derivative kick from setpoint changes
+    assert pid.update(0, current_time=1.0) == pytest.approx(0)
+    assert pid.update(-1, current_time=2.0) == pytest.approx(0.5)
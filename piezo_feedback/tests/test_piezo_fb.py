@@ -0,0 +1,211 @@
+import asyncio
+import importlib
+import time
+
+import numpy as np
+import pytest
+
+from piezo_feedback.tests.fakes import beam_image, make_devices
+
+
+def test_manager_heartbeat_only_on_the_hosting_machine(piezo_fb):
+    feedbacks = [piezo_fb.PiezoFeedback(*make_devices(host=host)) for host in ("remote", "elsewhere")]
+    manager = piezo_fb.FeedbackManager(feedbacks)
+    for _ in range(2):
+        manager.emit_heartbeat_signal(thresh=-1)
+    assert manager.heartbeat_signal.puts == [1]
+
+    feedbacks[0].hhm.fb_hostname.put("elsewhere")  # a standby manager
+    for _ in range(2):
+        manager.emit_heartbeat_signal(thresh=-1)
+    assert manager.heartbeat_signal.puts == [1]
+    manager.stop()
+
+
+def test_manager_stops_when_a_loop_dies(piezo_fb):
+    feedback = piezo_fb.PiezoFeedback(*make_devices())
+
+    def step():
+        raise RuntimeError("camera gone")
+
+    feedback.step = step
+    manager = piezo_fb.FeedbackManager([feedback])
+    manager.run(heartbeat_period=0.01)
+    assert not manager.loops_alive
+
+
+def test_stats_centroid_mode_gives_the_plugins_back(piezo_fb):
+    hhm, bpm_es, shutters = make_devices()
+    bpm_es.roi2.size.x.value = 1280  # e.g. set up by hand for a GUI
+    feedback = piezo_fb.PiezoFeedback(hhm, bpm_es, shutters)
+    with pytest.raises(RuntimeError):
+        feedback.use_stats_centroid()  # the centroid differs from the fitted center fb_center was set for
+    assert feedback.position_source == "image"
+    hhm.fb_status.put(0)
+    feedback.use_stats_centroid()
+    feedback.configure_stats_roi(feedback.parameters)
+    assert bpm_es.roi2.size.x.value == 20
+    assert bpm_es.stats2.nd_array_port.value == "ROI2"
+    assert bpm_es.roi1.size.x.puts == [] and bpm_es.stats1.nd_array_port.puts == []
+
+    hhm.fb_status.put(1)
+    with pytest.raises(RuntimeError):
+        feedback.use_image_analysis()
+    hhm.fb_status.put(0)
+    feedback.use_image_analysis()
+    assert bpm_es.roi2.size.x.value == 1280
+    assert bpm_es.stats2.nd_array_port.value == 0
+    assert feedback.position_source == "image"
+
+
+def test_ioc_binning_mode_gives_the_plugins_back(piezo_fb):
+    hhm, bpm_es, shutters = make_devices()
+    feedback = piezo_fb.PiezoFeedback(hhm, bpm_es, shutters)
+    feedback.use_ioc_binning()
+    feedback.configure_binning_roi(feedback.parameters)
+    assert bpm_es.roi2.bin_.x.value == 20
+    assert bpm_es.image.nd_array_port.value == "ROI2"
+
+    feedback.use_image_analysis()
+    assert bpm_es.roi2.bin_.x.value == 0
+    assert bpm_es.image.nd_array_port.value == "CAM"
+    assert bpm_es.roi1.bin_.x.puts == []
+
+
+def test_switching_between_frames_and_binned_profiles_after_a_while(piezo_fb):
+    hhm, bpm_es, shutters = make_devices()
+    image = beam_image(470.0)
+    bpm_es.image.array_data.put(image.ravel())
+    feedback = piezo_fb.PiezoFeedback(hhm, bpm_es, shutters)
+    assert feedback.find_beam_position()[1] == ""
+
+    feedback.use_ioc_binning()
+    feedback.previous_image_age = time.time() - 3  # the freeze check compares with the previous frame
+    bpm_es.image.array_data.put(image[:, :20].sum(axis=1))
+    assert feedback.find_beam_position()[1] == ""
+
+    feedback.use_image_analysis()
+    feedback.previous_image_age = time.time() - 3
+    bpm_es.image.array_data.put(image.ravel())
+    assert feedback.find_beam_position()[1] == ""
+
+
+def test_async_loop_triggers_its_frames(piezo_fb):
+    async_fb = importlib.import_module("piezo_feedback.async_fb")
+    hhm, bpm_es, shutters = make_devices()
+    feedback = async_fb.AsyncPiezoFeedback(hhm, bpm_es, shutters, frame_timeout=0.2)
+    feedback.use_triggered_acquisition()
+
+    def acquire(value, **kwargs):
+        if value == 1:
+            bpm_es.image.array_data.put(beam_image(470.0).ravel())
+            bpm_es.image.unique_id.put(bpm_es.image.unique_id.get() + 1)
+
+    bpm_es.acquire.subscribe(acquire, run=False)
+
+    async def adjust_pitch():
+        feedback._loop = asyncio.get_running_loop()
+        feedback._subscribe_events()
+        return await feedback.adjust_pitch_async()
+
+    assert asyncio.run(adjust_pitch())
+    assert hhm.fb_status_msg.value == ""
+    assert len(hhm.pitch.moves) == 1
+
+
+def test_async_loops_read_one_frame_at_a_time(piezo_fb):
+    async_fb = importlib.import_module("piezo_feedback.async_fb")
+    hhm, bpm_es, shutters = make_devices()
+    shutters["PH Shutter"].state.put(1)  # closed, the dark loop learns from every frame
+    feedback = async_fb.AsyncPiezoFeedback(hhm, bpm_es, shutters, frame_timeout=0.2)
+    feedback.use_dark_model()
+    running, overlaps, calls = [], [], []
+
+    def read_frame(*args):
+        overlaps.append(len(running))
+        running.append(True)
+        time.sleep(0.005)
+        running.pop()
+        calls.append(True)
+        return None, "fitting"
+
+    feedback.find_beam_position = read_frame
+    feedback.update_dark_model = read_frame
+
+    async def run():
+        feedback._loop = asyncio.get_running_loop()
+        feedback._subscribe_events()
+        dark_loop = asyncio.create_task(feedback.dark_loop())
+        for i in range(20):
+            bpm_es.image.array_counter.put(i + 1)
+            await feedback.adjust_pitch_async()
+        dark_loop.cancel()
+
+    asyncio.run(run())
+    assert len(calls) > 20 and max(overlaps) == 0
+
+
+def test_stale_frames_do_not_hide_a_frozen_camera(piezo_fb):
+    hhm, bpm_es, shutters = make_devices()
+    reboots = []
+    bpm_es.reboot_ioc = lambda: reboots.append(True)
+    bpm_es.image.array_data.put(beam_image(470.0).ravel())
+    feedback = piezo_fb.PiezoFeedback(hhm, bpm_es, shutters)
+    feedback._move_done = time.time() + 60  # every frame predates the last move
+    assert feedback.adjust_pitch()  # skipped silently
+    assert hhm.fb_status_err.puts == []
+
+    feedback._stale_since -= feedback.stale_timeout + 1
+    assert not feedback.adjust_pitch()
+    assert hhm.fb_status_msg.value == "no fresh frame"
+
+    feedback.previous_image_age -= 3  # the same frame for 3 s
+    assert not feedback.adjust_pitch()
+    assert hhm.fb_status_msg.value == "ioc freeze"
+    assert reboots == [True]
+
+
+def test_move_coalescer_gets_the_unfiltered_centroids(piezo_fb):
+    feedback = piezo_fb.PiezoFeedback(*make_devices())
+    feedback.use_position_estimator(process_noise=1e-3, measurement_variance=1.0)
+    feedback.use_move_coalescing(noise_window=200)
+    feedback.image_timestamp = 0.0
+    rng = np.random.default_rng(0)
+    for i, centroid in enumerate(480 + rng.normal(0, 0.5, 1000)):
+        feedback.image_timestamp = 0.01 * i
+        feedback.pitch_target_for(centroid, feedback.parameters)
+    assert feedback.move_coalescer.noise == pytest.approx(0.5, rel=0.2)
+
+
+def test_dark_model_starts_over_for_a_new_exposure(piezo_fb):
+    hhm, bpm_es, shutters = make_devices()
+    bpm_es.image.array_data.put(np.full((960, 1280), 3, dtype=np.int16).ravel())
+    feedback = piezo_fb.PiezoFeedback(hhm, bpm_es, shutters)
+    feedback.use_dark_model(min_frames=1)
+    feedback.update_dark_model()
+    assert feedback.dark_model.background(feedback.dark_key(feedback.parameters)) is not None
+
+    bpm_es.cam.acquire_time.put(0.02)
+    assert feedback.dark_model.background(feedback.dark_key(feedback.parameters)) is None
+
+
+def test_batch_fit_feeds_the_exposure_controller_and_the_frame_ring(piezo_fb):
+    frame_buffer = importlib.import_module("piezo_feedback.frame_buffer")
+    hhm, bpm_es, shutters = make_devices()
+    bpm_es.image.array_data.put(beam_image(470.0).ravel())
+    feedback = piezo_fb.PiezoFeedback(hhm, bpm_es, shutters)
+    feedback.use_exposure_control(target_counts=30)
+    name = frame_buffer.frame_ring_name("test_batch_fit")
+    feedback.publish_frames(name=name)
+    reader = frame_buffer.SharedFrameRingReader(name)
+    try:
+        feedback.update_center()
+        assert hhm.fb_center.value == pytest.approx(470.0, abs=0.5)
+        assert bpm_es.cam.acquire_time.puts == [pytest.approx(0.005)]
+        frame = reader.read_latest()
+        assert frame["seq"] == feedback.parameters.n_measures
+        assert frame["position"] == pytest.approx(470.0, abs=0.5) and frame["err_msg"] == ""
+        del frame
+    finally:
+        reader.close()
+        feedback.stop_publishing_frames()
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+p4p_server = pytest.importorskip("p4p.server")
+from p4p.client.thread import Context  # noqa: E402
+from p4p.nt import NTNDArray  # noqa: E402
+from p4p.server.thread import SharedPV  # noqa: E402
+
+from piezo_feedback.pva_source import PVAFrameSource  # noqa: E402
+
+PV_NAME = "TEST:piezo_fb:Pva1:Image"
+
+
+def compressed_frame(frame, codec):
+    value = NTNDArray().wrap(frame)
+    if codec == "lz4":
+        lz4_block = pytest.importorskip("lz4.block")
+        data = lz4_block.compress(frame.tobytes(), store_size=False)
+    elif codec == "blosc":
+        blosc = pytest.importorskip("blosc")
+        data = blosc.compress(frame.tobytes(), typesize=frame.itemsize)
+    else:
+        return value
+    value["value"] = ("ubyteValue", np.frombuffer(data, dtype=np.uint8))
+    value["codec.name"] = codec
+    value["codec.parameters"] = 6  # pvUShort
+    value["compressedSize"] = len(data)
+    return value
+
+
+@pytest.fixture
+def pva_server():
+    pv = SharedPV(initial=NTNDArray().wrap(np.zeros((2, 2), dtype=np.uint16)))
+    server = p4p_server.Server(providers=[{PV_NAME: pv}], isolate=True)
+    context = Context("pva", conf=server.conf(), useenv=False, nt=False)
+    yield pv, context
+    context.close()
+    server.stop()
+
+
+@pytest.mark.parametrize("codec", ["", "lz4", "blosc"])
+def test_pva_frame_source(pva_server, codec):
+    pv, context = pva_server
+    frame = np.arange(960 * 1280, dtype=np.uint16).reshape((960, 1280)) % 4000
+    value = compressed_frame(frame, codec)
+    value["uniqueId"] = 42
+    value["timeStamp.secondsPastEpoch"] = 1700000000
+    value["timeStamp.nanoseconds"] = 500000000
+    pv.post(value)
+
+    source = PVAFrameSource(PV_NAME, context=context)
+    image, timestamp = source.get_with_timestamp()
+    assert image.shape == frame.shape
+    assert np.array_equal(image, frame)
+    assert source.unique_id == 42
+    assert timestamp == 1700000000.5
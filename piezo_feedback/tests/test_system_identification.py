@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from piezo_feedback.system_identification import identify_plant
+
+
+def _closed_loop(plant_gain=100.0, dt=0.01, jitter=0.0, dither=0.002, n_samples=4000, seed=0):
+    # P loop as recorded by PiezoFeedback.record_history: the move to the pitch target is done by the next
+    # iteration and the beam follows the pitch one frame later (dead time of one sample), on top of a drift
+    rng = np.random.default_rng(seed)
+    kp = 0.2 / plant_gain
+    timestamps = 1000 + dt * np.arange(n_samples) + rng.normal(0, jitter, n_samples)
+    drift = np.cumsum(rng.normal(0, 0.05, n_samples))
+    history = {name: np.empty(n_samples) for name in ("pitch_target", "pitch_readback", "centroid", "dither")}
+    pitch_before, pitch, dither_offset = 300.0, 300.0, 0.0
+    for k in range(n_samples):
+        centroid = 480 + plant_gain * (pitch_before - 300.0) + drift[k] + rng.normal(0, 0.3)
+        new_dither_offset = dither * rng.choice((-1.0, 1.0))
+        pitch_target = pitch + kp * (480 - centroid) + new_dither_offset - dither_offset
+        dither_offset = new_dither_offset
+        history["pitch_target"][k], history["pitch_readback"][k] = pitch_target, pitch
+        history["centroid"][k], history["dither"][k] = centroid, dither_offset
+        pitch_before, pitch = pitch, pitch_target
+    return timestamps, history
+
+
+@pytest.mark.parametrize("jitter", [0.0, 1e-5])
+def test_closed_loop_plant_identification(jitter):
+    timestamps, history = _closed_loop(jitter=jitter)
+    result = identify_plant(
+        timestamps,
+        history["pitch_target"],
+        history["pitch_readback"],
+        history["centroid"],
+        dither=history["dither"],
+    )
+    assert result["excited"]
+    assert result["plant_gain"] == pytest.approx(100.0, rel=0.25)
+    assert result["dead_time"] == pytest.approx(0.01, abs=0.003)
+    assert result["actuator_dead_time"] == pytest.approx(0.01, abs=0.003)